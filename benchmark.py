@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import sys
+import json
+import random
+import shutil
+import pathlib
+import platform
+import resource
+import tempfile
+import time
+import subprocess
+import multiprocessing
+
+from PIL import Image
+
+import pendulum
+import toml
+
+import site_constructor
+
+
+# Top level spans of site_constructor.build, in order
+STAGES = [
+    "load posts", "copy assets", "write posts", "register images", "write index",
+    "search index", "subset fonts", "copy images", "precompress", "deploy manifest",
+]
+SCENARIOS = ["cold", "warm", "touch"]
+
+_WORDS = (
+    "le la les un une des et à de du en dans sur pour avec par nous vous "
+    "voyage montagne matin soleil chemin village lac forêt route journée "
+    "photo souvenir famille enfants repas soirée plage ville musée marché "
+    "était avons sommes fait très beau grand petit premier dernier encore"
+).split()
+
+
+def make_image(path, size, rng):
+    # Smooth colour noise: compresses like a photo, unlike pure noise
+    w, h = size
+    small = Image.new("RGB", (16, 16))
+    small.putdata([
+        (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        for _ in range(16 * 16)
+    ])
+    img = small.resize((w, h), Image.BICUBIC)
+    noise = Image.effect_noise((w, h), 24).convert("RGB")
+    img = Image.blend(img, noise, 0.15)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    img.save(path, "JPEG", quality=92)
+
+
+def make_paragraph(rng, nb_words):
+    words = [rng.choice(_WORDS) for _ in range(nb_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def make_site(root, posts=100, images=3, resolution=(3000, 2000), seed=0, workers=1):
+    rng = random.Random(seed)
+    root = pathlib.Path(root)
+    template = pathlib.Path(__file__).resolve().parent / "template"
+    originals = root / "originals"
+    matches = []
+    start = 1577836800  # 2020-01-01
+    for i in range(posts):
+        slug = "post-{:05d}".format(i)
+        date = start + i * 86400 + rng.randrange(86400)
+        body = []
+        for j in range(images):
+            original = originals / slug / "{:02d}.jpg".format(j)
+            make_image(original, resolution, rng)
+            target = root / "static" / "photos" / slug / "img{:02d}.jpg".format(j)
+            matches.append({
+                "date": None,
+                "hash": "0",
+                "path_target": str(target),
+                "path_matched": str(original),
+                "size_target": {"w": resolution[0] // 4, "h": resolution[1] // 4},
+                "size_matched": {"w": resolution[0], "h": resolution[1]},
+            })
+            body.append(make_paragraph(rng, rng.randrange(40, 200)))
+            body.append("![Photo {}](/photos/{}/img{:02d}.jpg)".format(j, slug, j))
+        body.append(make_paragraph(rng, rng.randrange(40, 200)))
+        post = root / "content" / "posts" / slug / "index.md"
+        post.parent.mkdir(parents=True, exist_ok=True)
+        with open(post, "w", encoding="utf-8") as fout:
+            fout.write("---\n")
+            json_fields = {
+                "title": "Article {} : {}".format(i, make_paragraph(rng, 4)),
+                "date": pendulum.from_timestamp(date).isoformat(),
+                "date_event": None,
+                "description": make_paragraph(rng, 12),
+                "categories": [rng.choice(["Voyage", "Cuisine", "Famille"])],
+                "resources": [{
+                    "name": "featuredImage",
+                    "src": "/photos/{}/img00.jpg".format(slug) if images else "",
+                    "params": {"description": "description"},
+                }],
+            }
+            # JSON is valid YAML
+            for key, value in json_fields.items():
+                fout.write("{}: {}\n".format(key, json.dumps(value, ensure_ascii=False)))
+            fout.write("---\n")
+            fout.write("\n\n".join(body))
+            fout.write("\n")
+    metadata = root / "static" / "photos" / "matcherdata.json"
+    metadata.parent.mkdir(parents=True, exist_ok=True)
+    with open(metadata, "w", encoding="utf-8") as fout:
+        json.dump({"version": "1.0", "root": str(root / "static"), "matches": matches}, fout)
+    config = {
+        "lang": "fr-fr",
+        "title": "Benchmark",
+        "description": "Synthetic site",
+        "brand": "Benchmark",
+        "posts_per_page": 8,
+        "home": {
+            "url": "index.html",
+            "title": "Benchmark",
+            "description": "Synthetic site",
+            "bgimg": "img/grey-cloud.jpg",
+        },
+        "paths": {"content": "content", "output": "output", "template": str(template)},
+        "photos": {
+            "metadata": "static/photos/matcherdata.json",
+            "max_img_size": [2500, 2500],
+            "max_thumb_size": [400, 300],
+            "max_file_size": "1024kb",
+            "highres": False,
+            "path": "photos",
+            "workers": workers,
+        },
+        "build": {"cache": ".cache", "incremental": True, "workers": workers},
+    }
+    with open(root / "config_site.toml", "w", encoding="utf-8") as fout:
+        toml.dump(config, fout)
+    return root
+
+
+def _run_build(root, queue, stages=None):
+    try:
+        queue.put(_build_stats(root, stages))
+    except Exception as err:
+        queue.put({"error": repr(err)})
+        raise
+
+
+def _build_stats(root, stages=None):
+    env = site_constructor.SiteEnvironment(root, profile=True)
+    start = time.perf_counter()
+    bucket = site_constructor.build(env, stages=stages)
+    build_s = time.perf_counter() - start
+    stages = {
+        e["name"]: e["dur"] / 1e6
+        for e in env.profiler.events
+        if e["name"] in STAGES
+    }
+    converted = sum(1 for e in env.profiler.events if e["name"] == "image decode")
+    rusage = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {
+        "posts": len(bucket),
+        "build_s": build_s,
+        "stages": stages,
+        "converted_images": converted,
+        "counters": env.profiler.counters,
+        # ru_maxrss is in kB on Linux
+        "peak_rss_mb": max(rusage) / 1024,
+    }
+
+
+def run_scenario(root, scenario, resolution, stages=None):
+    root = pathlib.Path(root)
+    if scenario == "cold":
+        shutil.rmtree(root / "output", ignore_errors=True)
+        shutil.rmtree(root / ".cache", ignore_errors=True)
+    elif scenario == "touch":
+        post = sorted((root / "content").rglob("*.md"))[0]
+        with open(post, "a", encoding="utf-8") as fout:
+            fout.write("\nModification.\n")
+    # A fresh process per scenario so that peak RSS is measured separately
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_build, args=(root, queue, stages))
+    process.start()
+    result = queue.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError("{} build failed: {}".format(scenario, result["error"]))
+    # The whole build, saving the caches and manifests included
+    total = result["build_s"]
+    write_posts = result["stages"].get("write posts", 0)
+    copy_images = result["stages"].get("copy images", 0)
+    megapixels = result["converted_images"] * resolution[0] * resolution[1] / 1e6
+    result["total_s"] = total
+    result["posts_per_s"] = result["posts"] / write_posts if write_posts else None
+    result["megapixels_per_s"] = megapixels / copy_images if copy_images and megapixels else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=pathlib.Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    for scenario, result in results["scenarios"].items():
+        print("{}: {:.2f} s total, {} posts, peak RSS {:.0f} MB".format(
+            scenario, result["total_s"], result["posts"], result["peak_rss_mb"]
+        ))
+        for stage in STAGES:
+            if stage in result["stages"]:
+                print("  {:<16} {:>8.2f} s".format(stage, result["stages"][stage]))
+        print("  {:<16} {:>8.2f} s".format("other", result["total_s"] - sum(result["stages"].values())))
+        if result["posts_per_s"]:
+            print("  {:>8.1f} posts/s".format(result["posts_per_s"]))
+        if result["megapixels_per_s"]:
+            print("  {:>8.1f} megapixels/s".format(result["megapixels_per_s"]))
+
+
+def compare(old, new):
+    print("Comparison with {} (commit {}):".format(old.get("date"), old.get("commit")))
+    if old["parameters"].get("stages") != new["parameters"]["stages"]:
+        print("  Warning the runs did not build the same stages")
+    for scenario, result in new["scenarios"].items():
+        before = old["scenarios"].get(scenario)
+        if before is None:
+            continue
+        rows = [("total", before["total_s"], result["total_s"])]
+        rows += [
+            (stage, before["stages"].get(stage, 0), result["stages"].get(stage, 0))
+            for stage in STAGES
+            if stage in before["stages"] or stage in result["stages"]
+        ]
+        rows.append(("peak RSS MB", before["peak_rss_mb"], result["peak_rss_mb"]))
+        print("  {}:".format(scenario))
+        for name, a, b in rows:
+            change = "{:+.1f}%".format((b - a) / a * 100) if a else "n/a"
+            print("    {:<16} {:>10.2f} {:>10.2f} {:>8}".format(name, a, b, change))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the site build on a synthetic site")
+    parser.add_argument("--posts", type=int, default=100)
+    parser.add_argument("--images", type=int, default=3, help="images per post")
+    parser.add_argument("--resolution", default="3000x2000", help="WxH of the source images")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument(
+        "--stages",
+        help="comma separated build stages to run, among {} (default: all)".format(
+            ", ".join(site_constructor.BUILD_STAGES)
+        )
+    )
+    parser.add_argument(
+        "--workdir",
+        default=os.path.join(tempfile.gettempdir(), "mini-blog-bench"),
+        help="where the synthetic site is generated"
+    )
+    parser.add_argument("--keep", action="store_true", help="reuse an existing synthetic site")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    args = parser.parse_args()
+
+    resolution = tuple(int(x) for x in args.resolution.lower().split("x"))
+    stages = args.stages.split(",") if args.stages else None
+    unknown = set(stages or []) - set(site_constructor.BUILD_STAGES)
+    if unknown:
+        print("Unknown stages {}".format(", ".join(sorted(unknown))))
+        sys.exit(-1)
+    root = pathlib.Path(args.workdir).resolve()
+    if not (args.keep and (root / "config_site.toml").exists()):
+        shutil.rmtree(root, ignore_errors=True)
+        print("Generating {} posts with {} images of {}x{}".format(
+            args.posts, args.images, *resolution
+        ))
+        make_site(root, args.posts, args.images, resolution, args.seed, args.workers)
+
+    results = {
+        "commit": git_commit(),
+        "date": pendulum.now().isoformat(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "parameters": {
+            "posts": args.posts,
+            "images": args.images,
+            "resolution": list(resolution),
+            "workers": args.workers,
+            "seed": args.seed,
+            "stages": stages,
+        },
+        "scenarios": {},
+    }
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            print("Unknown scenario {}".format(scenario))
+            sys.exit(-1)
+        results["scenarios"][scenario] = run_scenario(root, scenario, resolution, stages)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fout:
+            json.dump(results, fout, indent=4)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fin:
+            compare(json.load(fin), results)
+
+
+if __name__ == "__main__":
+    main()
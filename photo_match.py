@@ -17,6 +17,8 @@ from pendulum.parsing.exceptions import ParserError
 
 import jellyfish
 
+from site_imagebank import ImageBank
+
 
 _re_match_date_in_filename = re.compile((
     r"("
@@ -280,6 +282,9 @@ def match_images(path, savefile, bucket):
     for f in fda_images:
         matcher.match_add_path(f)
 
+    if pathlib.Path(savefile).suffix in ImageBank.SUFFIXES:
+        ImageBank.write(savefile, matcher.serialize())
+        return
     with open(savefile, "w", encoding="utf-8") as fout:
         data = {
             "version": "1.0",
@@ -289,13 +294,22 @@ def match_images(path, savefile, bucket):
         json.dump(data, fout, indent = 4)
 
 
+def convert_metadata(metadata):
+    # One-shot conversion of matcherdata.json to the indexed SQLite format
+    if pathlib.Path(metadata).suffix != ".json":
+        raise ValueError("{} is not a JSON metadata file".format(metadata))
+    database = pathlib.Path(metadata).with_suffix(".db")
+    ImageBank.convert(metadata, database)
+    return database
+
+
 def main():
     import sys
     import toml
     import os.path
 
-    if len(sys.argv) != 2:
-        print("Usage: {} path/to/site".format(sys.argv[0]))
+    if len(sys.argv) < 2 or sys.argv[2:] not in ([], ["--convert"]):
+        print("Usage: {} path/to/site [--convert]".format(sys.argv[0]))
         sys.exit(-1)
 
     configpath = os.path.join(
@@ -306,6 +320,19 @@ def main():
         config = toml.load(fin)
         photoscfg = config.get("photos", {})
     
+    metadata = os.path.join(
+        os.path.abspath(sys.argv[1]),
+        photoscfg.get("metadata", "matcherdata.json")
+    )
+    if sys.argv[2:] == ["--convert"]:
+        try:
+            database = convert_metadata(metadata)
+        except ValueError as err:
+            print("Cannot convert: {}, photos.metadata must point to the JSON file".format(err))
+            sys.exit(-1)
+        print("Wrote {}, set photos.metadata to use it".format(database))
+        sys.exit(0)
+
     cache = photoscfg.get("cache", "")
     originals = photoscfg.get("originals", "")
     force_recreate_cache = photoscfg.get("force_recreate_cache", True)
@@ -314,10 +341,6 @@ def main():
     
     bucket = load_bucket(cache)
 
-    metadata = os.path.join(
-        os.path.abspath(sys.argv[1]),
-        photoscfg.get("metadata", "matcherdata.json")
-    )
     downloaded = os.path.join(
         os.path.abspath(sys.argv[1]),
         "static",
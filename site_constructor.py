@@ -1,32 +1,828 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import abc
 import json
+import base64
 import re
+import hashlib
+import importlib.util
 import pathlib
 import shutil
 import copy
+import filecmp
+import gzip
+import io
+import datetime
 import posixpath
 import itertools
 import math
+import time
+import threading
+import contextlib
+import tempfile
+from html import unescape
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import frontmatter
-import pendulum
 import toml
 
-from wand.image import Image as WandImage
+from slugify import slugify
 
-import markdown
-from markdown.treeprocessors import Treeprocessor
-from markdown.extensions import Extension
+from tqdm import tqdm
 
-import markupsafe
-from jinja2 import Environment, FileSystemLoader
+from site_imagebank import ImageBank, bank_key
 
-from slugify import slugify
-from typographeur import typographeur
+# Wand, markdown, typographeur, Jinja, frontmatter, pendulum, fontTools and
+# brotli are imported by the stages that use them, so that partial builds
+# start fast
 
-from tqdm import tqdm
+
+def _available(module):
+    return importlib.util.find_spec(module) is not None
+
+
+class FileDigests:
+    def __init__(self, memo=None):
+        # path -> [size, mtime_ns, sha1], reused while the file stat is unchanged
+        self.memo = memo if memo is not None else {}
+        self._seen = {}
+    
+    def digest(self, path):
+        path = str(path)
+        if path in self._seen:
+            return self._seen[path]
+        try:
+            st = os.stat(path)
+        except OSError:
+            digest = None
+        else:
+            cached = self.memo.get(path)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                digest = cached[2]
+            else:
+                digest = self._hash_file(path)
+                self.memo[path] = [st.st_size, st.st_mtime_ns, digest]
+        self._seen[path] = digest
+        return digest
+    
+    @staticmethod
+    def _hash_file(path):
+        h = hashlib.sha1()
+        with open(path, "rb") as fin:
+            for chunk in iter(lambda: fin.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+    
+    def serialize(self):
+        return {path: self.memo[path] for path in self._seen if path in self.memo}
+    
+    def forget(self):
+        # Files may have changed since they were seen: stat them again
+        self._seen = {}
+    
+    def drain(self):
+        # Entries seen since the last drain, to be merged by another process
+        entries = self.serialize()
+        self._seen = {}
+        return entries
+    
+    def update(self, entries):
+        for path, entry in entries.items():
+            self.memo[path] = entry
+            self._seen[path] = entry[2]
+
+
+class BuildManifest:
+    API = "1.0"
+    
+    def __init__(self, path, incremental=False):
+        self.path = pathlib.Path(path)
+        self.incremental = incremental
+        self.outputs = {}
+        self.records = {}
+        self.digests = FileDigests()
+    
+    @classmethod
+    def load(cls, path, incremental=False):
+        self = cls(path, incremental)
+        try:
+            with open(self.path, "r", encoding="utf-8") as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            return self
+        if data.get("version") != cls.API:
+            return self
+        self.outputs = data["outputs"]
+        self.digests = FileDigests(data["digests"])
+        return self
+    
+    def snapshot(self, deps):
+        return {str(dep): self.digests.digest(dep) for dep in deps}
+    
+    def previous(self, target):
+        return self.outputs.get(str(target))
+    
+    def is_fresh(self, target, deps, params=None):
+        if not self.incremental:
+            return False
+        old = self.previous(target)
+        if old is None or not pathlib.Path(target).exists():
+            return False
+        if old["params"] != self._normalize(params):
+            return False
+        if not {str(dep) for dep in deps} <= old["deps"].keys():
+            return False
+        # Extra deps recorded by the previous build (e.g. matched images)
+        # must be unchanged as well
+        return all(
+            self.digests.digest(dep) == digest
+            for dep, digest in old["deps"].items()
+        )
+    
+    def record(self, target, deps, params=None, images=None, mapping=None):
+        self.records[str(target)] = {
+            "deps": self.snapshot(deps),
+            "params": self._normalize(params),
+            "images": images or [],
+            "mapping": mapping,
+        }
+    
+    def keep(self, target):
+        self.records[str(target)] = self.outputs[str(target)]
+    
+    def carry_over(self):
+        for target, record in self.outputs.items():
+            self.records.setdefault(target, record)
+    
+    def keep_previous(self):
+        # The outputs went somewhere else: the output folder, and so the
+        # reference of the next build, is still the one of the previous build
+        self.records = dict(self.outputs)
+    
+    def restart(self):
+        # The outputs of this build are the reference of the next one
+        self.outputs, self.records = self.records, {}
+        self.digests.forget()
+    
+    @staticmethod
+    def _normalize(params):
+        # Round-trip through JSON so that tuples compare equal to the lists
+        # read back from disk
+        return json.loads(json.dumps(params))
+    
+    def save(self):
+        save_json(self.path, {
+            "version": self.API,
+            "outputs": self.records,
+            "digests": self.digests.serialize(),
+        })
+
+
+def _temp_path(path):
+    return path.with_name(".{}.{}.tmp".format(path.name, os.getpid()))
+
+
+def write_if_changed(path, data):
+    # Leave the file, and its mtime, alone when the content is the same;
+    # otherwise replace it atomically so that nobody sees a partial file
+    path = pathlib.Path(path)
+    try:
+        if path.stat().st_size == len(data):
+            with open(path, "rb") as fin:
+                if fin.read() == data:
+                    return False
+    except OSError:
+        pass
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temp_path(path)
+    try:
+        with open(tmp, "wb") as fout:
+            fout.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return True
+
+
+def save_json(path, data, **kwargs):
+    # A build interrupted while saving its state keeps the previous file
+    # instead of a truncated one
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temp_path(path)
+    try:
+        with open(tmp, "w", encoding="utf-8") as fout:
+            json.dump(data, fout, **kwargs)
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def copy_if_changed(src, dst, link=False):
+    dst = pathlib.Path(dst)
+    try:
+        if os.path.samefile(src, dst) or filecmp.cmp(src, dst, shallow=False):
+            return False
+    except OSError:
+        pass
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temp_path(dst)
+    tmp.unlink(missing_ok=True)
+    try:
+        if link:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                shutil.copy2(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+        # Replacing the entry never writes through an existing hardlink
+        os.replace(tmp, dst)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return True
+
+
+# Outputs kept readable by the streaming backends, and precompressed
+TEXT_SUFFIXES = [".html", ".css", ".js", ".json", ".svg"]
+
+
+class FileBackend:
+    # Outputs written in place in the output folder
+    in_place = True
+    
+    def __init__(self, root, digests=None):
+        self.root = pathlib.Path(root)
+        self.digests = digests if digests is not None else FileDigests()
+    
+    def write(self, path, data):
+        return write_if_changed(path, data)
+    
+    def copy(self, src, path, link=False):
+        return copy_if_changed(src, path, link=link)
+    
+    def read(self, path):
+        return pathlib.Path(path).read_bytes()
+    
+    def digest(self, path):
+        return self.digests.digest(path)
+    
+    def exists(self, path):
+        return pathlib.Path(path).is_file()
+    
+    def close(self):
+        pass
+    
+    def abort(self):
+        pass
+
+
+class _HashingReader:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha1()
+    
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+class PackageBackend(abc.ABC):
+    # Every output streamed into a single artifact instead of the output
+    # folder. Nothing from a previous build is reused in place, so the build
+    # is a full one; the text outputs stay readable for the later stages
+    in_place = False
+    
+    def __init__(self, root, path):
+        self.root = pathlib.Path(root)
+        self.path = pathlib.Path(path)
+        self.entries = {}
+        self.mtime = int(time.time())
+    
+    def name(self, path):
+        return pathlib.Path(path).relative_to(self.root).as_posix()
+    
+    def _is_new(self, name):
+        if name in self.entries:
+            print("Output {} written twice, keeping the first one".format(name))
+            return False
+        return True
+    
+    @abc.abstractmethod
+    def local(self, path):
+        # File holding the content of a text output, for the later stages
+        ...
+    
+    def read(self, path):
+        return self.local(path).read_bytes()
+    
+    def digest(self, path):
+        try:
+            return self.entries.get(self.name(path))
+        except ValueError:
+            return None
+    
+    def exists(self, path):
+        return self.digest(path) is not None
+    
+    def close(self):
+        print("Wrote {} files to {}".format(len(self.entries), self.path))
+
+
+class ArchiveBackend(PackageBackend):
+    # Outputs added to the archive as they are written. The text outputs
+    # are also spooled to disk, so that the site is never held in memory
+    
+    def __init__(self, root, path):
+        super().__init__(root, path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = _temp_path(self.path)
+        self.spool = pathlib.Path(
+            tempfile.mkdtemp(prefix=".{}.".format(self.path.name), dir=str(self.path.parent))
+        )
+        self.archive = self._open(self.tmp)
+    
+    def write(self, path, data):
+        name = self.name(path)
+        if not self._is_new(name):
+            return False
+        self._add(name, io.BytesIO(data), len(data))
+        self.entries[name] = hashlib.sha1(data).hexdigest()
+        if posixpath.splitext(name)[1] in TEXT_SUFFIXES:
+            spooled = self.spool / name
+            spooled.parent.mkdir(parents=True, exist_ok=True)
+            spooled.write_bytes(data)
+        return True
+    
+    def copy(self, src, path, link=False):
+        # Streamed by chunks: large images are never held in memory
+        name = self.name(path)
+        if not self._is_new(name):
+            return False
+        with open(src, "rb") as fin:
+            reader = _HashingReader(fin)
+            self._add(name, reader, os.fstat(fin.fileno()).st_size)
+        self.entries[name] = reader.hash.hexdigest()
+        return True
+    
+    def local(self, path):
+        name = self.name(path)
+        spooled = self.spool / name
+        if name not in self.entries or not spooled.is_file():
+            raise FileNotFoundError(name)
+        return spooled
+    
+    @abc.abstractmethod
+    def _open(self, path):
+        ...
+    
+    @abc.abstractmethod
+    def _add(self, name, fileobj, size):
+        ...
+    
+    def close(self):
+        self.archive.close()
+        os.replace(self.tmp, self.path)
+        shutil.rmtree(self.spool, ignore_errors=True)
+        super().close()
+    
+    def abort(self):
+        self.archive.close()
+        self.tmp.unlink(missing_ok=True)
+        shutil.rmtree(self.spool, ignore_errors=True)
+
+
+class TarBackend(ArchiveBackend):
+    MODES = {".tar": "w|", ".gz": "w|gz", ".tgz": "w|gz", ".bz2": "w|bz2", ".xz": "w|xz"}
+    
+    def _open(self, path):
+        import tarfile
+        return tarfile.open(str(path), self.MODES[self.path.suffix])
+    
+    def _add(self, name, fileobj, size):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.archive.addfile(info, fileobj)
+
+
+class ZipBackend(ArchiveBackend):
+    def _open(self, path):
+        import zipfile
+        return zipfile.ZipFile(path, "w")
+    
+    def _add(self, name, fileobj, size):
+        import zipfile
+        info = zipfile.ZipInfo(name, time.localtime(self.mtime)[:6])
+        info.external_attr = 0o644 << 16
+        # Images are compressed already
+        if posixpath.splitext(name)[1] in TEXT_SUFFIXES:
+            info.compress_type = zipfile.ZIP_DEFLATED
+        with self.archive.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as fout:
+            shutil.copyfileobj(fileobj, fout, 1 << 20)
+
+
+class BlobBackend(PackageBackend):
+    # Content-addressed folder: blobs/<sha1[:2]>/<sha1> and an index.json
+    # from output names to blobs. Blobs are shared between builds, so only
+    # new content is written
+    API = "1.0"
+    INDEX_FILE = "index.json"
+    
+    def _blob(self, digest):
+        return self.path / "blobs" / digest[:2] / digest
+    
+    def write(self, path, data):
+        name = self.name(path)
+        if not self._is_new(name):
+            return False
+        digest = hashlib.sha1(data).hexdigest()
+        written = write_if_changed(self._blob(digest), data)
+        self.entries[name] = digest
+        return written
+    
+    def copy(self, src, path, link=False):
+        name = self.name(path)
+        if not self._is_new(name):
+            return False
+        digest = FileDigests._hash_file(src)
+        blob = self._blob(digest)
+        written = not blob.exists()
+        if written:
+            copy_if_changed(src, blob, link=link)
+        self.entries[name] = digest
+        return written
+    
+    def local(self, path):
+        digest = self.digest(path)
+        if digest is None:
+            raise FileNotFoundError(path)
+        return self._blob(digest)
+    
+    def close(self):
+        write_if_changed(
+            self.path / self.INDEX_FILE,
+            json.dumps(
+                {"version": self.API, "files": self.entries}, indent=1, sort_keys=True
+            ).encode("utf-8")
+        )
+        super().close()
+    
+    def abort(self):
+        pass
+
+
+def make_backend(package, root, digests=None):
+    # package: None for the output folder, an archive (.tar, .tar.gz,
+    # .tgz, .tar.bz2, .tar.xz, .zip) or a content-addressed folder
+    if package is None:
+        return FileBackend(root, digests)
+    package = pathlib.Path(package)
+    if package.suffix == ".zip":
+        return ZipBackend(root, package)
+    if package.suffix in [".tar", ".tgz"] or package.suffixes[-2:-1] == [".tar"]:
+        if package.suffix not in TarBackend.MODES:
+            raise ValueError("Unsupported archive compression {}".format(package.suffix))
+        return TarBackend(root, package)
+    return BlobBackend(root, package)
+
+
+class DeployManifest:
+    # Content hashes of every output and the difference with the previous
+    # build, so that a deploy only ships the delta
+    API = "1.0"
+    
+    def __init__(self, path, root):
+        self.path = pathlib.Path(path)
+        self.root = pathlib.Path(root)
+        self.previous = {}
+        self.stale = []
+        self.files = {}
+        self.added = []
+        self.changed = []
+        self.removed = []
+    
+    @classmethod
+    def load(cls, path, root):
+        self = cls(path, root)
+        try:
+            with open(self.path, "r", encoding="utf-8") as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            return self
+        if data.get("version") != cls.API:
+            return self
+        self.previous = data["files"]
+        self.stale = data.get("stale", [])
+        return self
+    
+    def update(self, outputs, digests):
+        files = {}
+        for output in outputs:
+            path = pathlib.Path(output)
+            try:
+                name = path.relative_to(self.root).as_posix()
+            except ValueError:
+                continue
+            digest = digests.digest(path)
+            if digest is not None:
+                files[name] = digest
+        self.added = sorted(files.keys() - self.previous.keys())
+        self.changed = sorted(
+            name for name in files.keys() & self.previous.keys()
+            if files[name] != self.previous[name]
+        )
+        self.removed = sorted(self.previous.keys() - files.keys())
+        # Removed outputs stay on disk until a build prunes them
+        self.stale = sorted((set(self.stale) | set(self.removed)) - files.keys())
+        self.files = files
+    
+    def prune(self):
+        # Only outputs of a previous build are deleted, never unknown files
+        for name in self.stale:
+            path = self.root / name
+            path.unlink(missing_ok=True)
+            parent = path.parent
+            while parent != self.root:
+                try:
+                    parent.rmdir()
+                except OSError:
+                    break
+                parent = parent.parent
+        self.stale = []
+    
+    def save(self):
+        save_json(
+            self.path,
+            {
+                "version": self.API,
+                "files": self.files,
+                "added": self.added,
+                "changed": self.changed,
+                "removed": self.removed,
+                "stale": self.stale,
+            },
+            indent=1
+        )
+
+
+class Profiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self.counters = {}
+    
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter_ns() - start, **args)
+    
+    def add(self, name, start, duration, **args):
+        # Chrome trace-event "complete" event, timestamps in microseconds
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": duration / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": {key: str(value) for key, value in args.items()},
+        })
+    
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def drain(self):
+        # Events and counters recorded since the last drain, to be merged
+        # by another process
+        data = {"events": self.events, "counters": self.counters}
+        self.events, self.counters = [], {}
+        return data
+    
+    def update(self, data):
+        self.events.extend(data["events"])
+        for name, value in data["counters"].items():
+            self.count(name, value)
+    
+    def save(self, path):
+        events = list(self.events)
+        ts = max((e["ts"] + e["dur"] for e in events), default=0)
+        events.extend(
+            {"name": name, "ph": "C", "ts": ts, "pid": os.getpid(), "args": {name: value}}
+            for name, value in self.counters.items()
+        )
+        with open(path, "w", encoding="utf-8") as fout:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fout)
+    
+    def summary(self, top=10):
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event["name"], [0, 0])
+            total[0] += 1
+            total[1] += event["dur"]
+        print("Time per stage:")
+        for name, (count, dur) in sorted(totals.items(), key=lambda x: -x[1][1]):
+            print("  {:<24} {:>6} calls {:>10.1f} ms".format(name, count, dur / 1000))
+        for name, key in (("post", "url"), ("image", "src")):
+            slowest = sorted(
+                (e for e in self.events if e["name"] == name),
+                key=lambda e: -e["dur"]
+            )[:top]
+            if slowest:
+                print("Slowest {}s:".format(name))
+                for event in slowest:
+                    print("  {:>10.1f} ms  {}".format(event["dur"] / 1000, event["args"].get(key)))
+        if self.counters:
+            print("Counters:")
+            for name, value in sorted(self.counters.items()):
+                print("  {:<24} {:>10}".format(name, value))
+
+
+def parse_size(value):
+    if value is None or isinstance(value, int):
+        return value
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*", str(value).lower())
+    if not m:
+        raise ValueError("Invalid size {!r}".format(value))
+    factor = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30}[m[2]]
+    return int(float(m[1]) * factor)
+
+
+class DiskCache:
+    API = "1.0"
+    INDEX_FILE = "index.json"
+    
+    def __init__(self, folder, max_size=None):
+        self.folder = pathlib.Path(folder)
+        self.max_size = parse_size(max_size)
+        # key -> [last use timestamp, size], used for LRU eviction
+        self.index = {}
+        self._touched = set()
+        try:
+            with open(self.folder / self.INDEX_FILE, "r", encoding="utf-8") as fin:
+                data = json.load(fin)
+            if data.get("version") == self.API:
+                self.index = data["entries"]
+        except (OSError, ValueError):
+            pass
+    
+    def _path(self, key, suffix=""):
+        return self.folder / key[:2] / (key + suffix)
+    
+    def _use(self, key, size=None):
+        if size is None:
+            size = self.index.get(key, [0, 0])[1]
+        self.index[key] = [time.time(), size]
+        self._touched.add(key)
+    
+    def drain(self):
+        # Entries used since the last drain, to be merged by another process
+        entries = {key: self.index[key] for key in self._touched if key in self.index}
+        self._touched = set()
+        return entries
+    
+    def update(self, entries):
+        self.index.update(entries)
+    
+    def get_blob(self, key, suffix=""):
+        cached = self._path(key, suffix)
+        if key not in self.index or not cached.exists():
+            return None
+        self._use(key)
+        return cached.read_bytes()
+    
+    def put_blob(self, key, data, suffix=""):
+        # Workers may store the same key at once: never show a partial file
+        write_if_changed(self._path(key, suffix), data)
+        self._use(key, len(data))
+    
+    def _remove(self, key):
+        for p in self.folder.glob("{}/{}*".format(key[:2], key)):
+            p.unlink()
+        self.index.pop(key, None)
+    
+    def evict(self):
+        if self.max_size is None:
+            return
+        total = sum(size for _, size in self.index.values())
+        by_age = sorted(self.index.items(), key=lambda item: item[1][0])
+        for key, (_, size) in by_age:
+            if total <= self.max_size:
+                break
+            self._remove(key)
+            total -= size
+    
+    def save(self):
+        self.evict()
+        save_json(self.folder / self.INDEX_FILE, {"version": self.API, "entries": self.index})
+
+
+class ImageCache(DiskCache):
+    def __init__(self, folder, max_size=None, digests=None):
+        super().__init__(folder, max_size)
+        self.digests = digests if digests is not None else FileDigests()
+    
+    def key(self, src, params):
+        h = hashlib.sha256()
+        h.update(self.API.encode())
+        h.update(str(self.digests.digest(src)).encode())
+        h.update(json.dumps(params).encode())
+        return h.hexdigest()
+    
+    def fetch(self, key, dst, backend=None):
+        cached = self._path(key, pathlib.Path(dst).suffix)
+        if key not in self.index or not cached.exists():
+            return False
+        if backend is not None:
+            backend.copy(cached, dst, link=True)
+        else:
+            copy_if_changed(cached, dst, link=True)
+        self._use(key)
+        return True
+    
+    def store(self, key, dst):
+        cached = self._path(key, pathlib.Path(dst).suffix)
+        copy_if_changed(dst, cached, link=True)
+        self._use(key, cached.stat().st_size)
+
+
+def fit_size(size, max_size):
+    w, h = size
+    mw, mh = max_size
+    rw, rh = w, h
+    if mw is not None:
+        rw, rh = min(rw, mw), min(rh, int(h * mw / w))
+    if mh is not None:
+        rw, rh = min(rw, int(w * mh / h)), min(rh, mh)
+    return rw, rh
+
+
+def variant_path(destination, width, fmt="jpeg"):
+    suffix = "jpg" if fmt == "jpeg" else fmt
+    return destination.with_name("{}-{}w.{}".format(destination.stem, width, suffix))
+
+
+PLACEHOLDER_SIZE = 20
+
+
+MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "avif": "image/avif",
+}
+
+
+class ImageVariant(namedtuple("ImageVariant", ["dst", "format", "max_file_size", "max_img_size"])):
+    def params(self):
+        return [self.format, self.max_file_size, self.max_img_size]
+
+
+class FragmentCache(DiskCache):
+    def __init__(self, folder, max_size=None):
+        super().__init__(folder, max_size)
+        self._salt = None
+    
+    @property
+    def salt(self):
+        if self._salt is None:
+            import importlib.metadata
+            import site_markdown
+            self._salt = json.dumps([
+                self.API,
+                site_markdown.VERSION,
+                importlib.metadata.version("Markdown"),
+                importlib.metadata.version("typographeur"),
+            ])
+        return self._salt
+    
+    def key(self, body, folder_name, url):
+        h = hashlib.sha256()
+        for part in (self.salt, folder_name, url, body):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+    
+    def get(self, key):
+        data = self.get_blob(key, ".json")
+        return json.loads(data) if data is not None else None
+    
+    def put(self, key, entry):
+        self.put_blob(key, json.dumps(entry).encode("utf-8"), ".json")
 
 
 class ImageFolder:
@@ -35,52 +831,162 @@ class ImageFolder:
                  assets_folder,
                  max_img_size = None,
                  max_file_size = None,
-                 max_thumb_size=(400, 300)
+                 max_thumb_size=(400, 300),
+                 manifest=None,
+                 workers=None,
+                 cache=None,
+                 responsive_widths=(),
+                 sizes=None,
+                 formats=None,
+                 placeholders=False,
+                 backend=None,
+                 staging=None
                 ):
         self.output_folder = output_folder
         self.assets_folder = assets_folder
         self.max_img_size = max_img_size
         self.max_file_size = max_file_size
         self.max_thumb_size = max_thumb_size
+        self.manifest = manifest
+        self.digests = manifest.digests if manifest is not None else FileDigests()
+        self.workers = workers or os.cpu_count() or 1
+        self.cache = cache
+        self.responsive_widths = sorted(responsive_widths)
+        self.sizes = sizes
+        # format -> max file size, in <source> order
+        formats = formats or {}
+        self._formats = {
+            fmt: formats[fmt] for fmt in ("avif", "webp") if fmt in formats
+        }
+        self._supported = None
+        self.placeholders = placeholders
+        self.backend = backend if backend is not None else FileBackend(output_folder)
+        # Where conversions are written when the backend streams the outputs
+        self.staging = staging
+        self.profiler = Profiler()
         self.images = {}
         self.thumbs = {}
         self.counters = {}
+        # Sizes read from the files missing from the image bank
+        self.source_sizes = {}
     
     @classmethod
-    def make(cls,
-             metadatafile,
-             output_folder,
-             assets_folder,
-             max_img_size = None,
-             max_file_size = None,
-             max_thumb_size=(400, 300)
-            ):
-        self = cls(output_folder, assets_folder, max_img_size, max_file_size, max_thumb_size)
-        with open(metadatafile, "r", encoding="utf-8") as fin:
-            metadata = json.load(fin)
-            self.image_bank = {}
-            for data in metadata["matches"]:
-                path_matched = data["path_matched"] or data["path_target"]
-                p = pathlib.Path(data["path_target"])
-                index = str(pathlib.Path(*p.parts[-2:]))
-                self.image_bank[index] = path_matched
+    def make(cls, metadatafile, output_folder, assets_folder, **kwargs):
+        self = cls(output_folder, assets_folder, **kwargs)
+        self.image_bank = ImageBank.make(metadatafile)
         return self
     
+    @property
+    def formats(self):
+        # The configured formats ImageMagick knows, checked on first use.
+        # JPEG is always made, as the fallback
+        if self._supported is None:
+            self._supported = {}
+            if self._formats:
+                from wand.version import formats as magick_formats
+                for fmt, max_file_size in self._formats.items():
+                    if magick_formats(fmt.upper()):
+                        self._supported[fmt] = max_file_size
+                    else:
+                        print("ImageMagick has no {} support, skipping these images".format(fmt))
+        return self._supported
+    
+    def output_size(self, source, max_img_size):
+        # Dimensions of a converted image, computed as _do_convert resizes it
+        size = self.source_size(source)
+        if size is None or max_img_size is None:
+            return size
+        return fit_size(size, max_img_size)
+    
+    def source_size(self, source):
+        size = self.image_bank.size(source)
+        if size is None:
+            # Not in the image bank: only the header of the file is read
+            if source not in self.source_sizes:
+                self.source_sizes[source] = self._read_size(source)
+            size = self.source_sizes[source]
+        return size
+    
+    @staticmethod
+    def _read_size(src):
+        from wand.image import Image as WandImage
+        try:
+            with WandImage.ping(filename=str(src)) as img:
+                return img.size
+        except Exception:
+            return None
+    
+    @property
+    def vanilla(self):
+        # The JPEG images are copied as they are, without resizing
+        return (self.max_file_size is None) and (self.max_img_size is not None)
+    
+    def max_size(self, fmt="jpeg"):
+        # Bounding box of the full size images of a format
+        if fmt == "jpeg" and self.vanilla:
+            return None
+        return self.max_img_size
+    
+    def dimensions(self, path):
+        source = self.source(path)
+        if source not in self.images:
+            return None
+        return self.output_size(source, self.max_size())
+    
+    def thumb_dimensions(self, path):
+        source = self.source(path)
+        if source not in self.thumbs:
+            return None
+        return self.output_size(source, self.max_thumb_size)
+    
+    def reset(self):
+        self.images = {}
+        self.thumbs = {}
+        self.counters = {}
+    
+    def is_independent(self, paths, folder):
+        # True when registering these images from a blank state gives the
+        # same destinations as registering them after the current ones
+        if (self.output_folder / folder) in self.counters:
+            return False
+        return not any(self.source(path) in self.images for path in paths)
+    
+    def checkpoint(self, paths, folder):
+        directory = self.output_folder / folder
+        added = [
+            source for source in map(self.source, paths)
+            if source not in self.images
+        ]
+        return directory, self.counters.get(directory), added
+    
+    def rollback(self, checkpoint):
+        # Forget the registrations made since checkpoint()
+        directory, counter, added = checkpoint
+        if counter is None:
+            self.counters.pop(directory, None)
+        else:
+            self.counters[directory] = counter
+        for source in added:
+            self.images.pop(source, None)
+    
+    def source(self, path):
+        index = bank_key(path)
+        matched = self.image_bank.source(index)
+        return matched if matched else path
+    
     def match(self, path, folder):
-        p = pathlib.Path(path).parts[-2:]
-        index = "/".join(p)
-        matched = self.image_bank.get(index)
+        index = bank_key(path)
+        matched = self.image_bank.source(index)
         source = matched if matched else path
         if source in self.images:
             destination = self.images[source]
         else:
             directory = self.output_folder / folder
-            if (self.max_file_size is None) and (self.max_img_size is not None):
+            if self.vanilla:
                 new_name = pathlib.Path(source).name
             else:
-                if directory not in self.counters:
-                    self.counters[directory] = itertools.count(1)
-                new_name = "{:03d}.jpg".format(next(self.counters[directory]))
+                self.counters[directory] = self.counters.get(directory, 0) + 1
+                new_name = "{:03d}.jpg".format(self.counters[directory])
             destination = directory / new_name
             if not matched:
                 print("Warning image {} not found".format(index))
@@ -89,14 +995,13 @@ class ImageFolder:
         return destination
 
     def thumb(self, path, name):
-        p = pathlib.Path(path).parts[-2:]
-        index = "/".join(p)
-        matched = self.image_bank.get(index)
+        index = bank_key(path)
+        matched = self.image_bank.source(index)
         source = matched if matched else path
         if source in self.thumbs:
-            destination = self.images[source]
+            relpath = pathlib.PurePosixPath(self.thumbs[source].relative_to(self.assets_folder))
         else:
-            relpath = pathlib.PurePosixPath("img") / "{}.jpg".format(name)
+            relpath = pathlib.PurePosixPath("img") / "{}.{}.jpg".format(name, self._thumb_hash(source))
             destination = self.assets_folder / relpath
             if not matched:
                 print("Warning image {} not found".format(index))
@@ -104,69 +1009,281 @@ class ImageFolder:
                 self.thumbs[source] = destination
         return relpath.as_posix()
     
+    def _thumb_hash(self, source):
+        # The assets are served immutable: the name changes with the source
+        # and the size of the thumbnail, known before it is converted
+        h = hashlib.sha1(json.dumps([
+            self.digests.digest(source), self.max_thumb_size
+        ]).encode("utf-8"))
+        return h.hexdigest()[:AssetPipeline.HASH_LENGTH]
+    
+    def thumb_sources(self, path):
+        # Alternative formats of a thumbnail, as <source> data for templates
+        source = self.source(path)
+        if source not in self.thumbs:
+            return []
+        relpath = pathlib.PurePosixPath(self.thumbs[source].relative_to(self.assets_folder))
+        return [
+            {"type": MIME_TYPES[fmt], "src": relpath.with_suffix("." + fmt).as_posix()}
+            for fmt in self.formats
+        ]
+    
+    def placeholder(self, path):
+        # Tiny blurred JPEG as a data URI, shown while the real image loads
+        if not self.placeholders:
+            return None
+        source = self.source(path)
+        if source not in self.images and source not in self.thumbs:
+            return None
+        params = ["placeholder", PLACEHOLDER_SIZE]
+        if self.cache is not None:
+            key = self._cache_key(source, params)
+            data = self.cache.get_blob(key, ".lqip")
+            if data is None:
+                with self.profiler.span("image placeholder", src=source):
+                    data = self._make_placeholder(source)
+                self.cache.put_blob(key, data, ".lqip")
+        else:
+            with self.profiler.span("image placeholder", src=source):
+                data = self._make_placeholder(source)
+        return "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii")
+    
+    @staticmethod
+    def _make_placeholder(src):
+        from wand.image import Image as WandImage
+        with WandImage() as img:
+            # Let the JPEG decoder downscale while reading
+            img.options['jpeg:size'] = "{0}x{0}".format(PLACEHOLDER_SIZE * 4)
+            img.read(filename=src)
+            w, h = fit_size(img.size, (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+            img.resize(max(w, 1), max(h, 1))
+            img.strip()
+            img.format = 'jpeg'
+            img.compression_quality = 40
+            return img.make_blob()
+    
     def do_copy(self):
-        if (self.max_file_size is None) and (self.max_img_size is not None):
-            self._do_copy_vanilla()
+        variants = {}
+        copies = []
+        for src, dst in self.images.items():
+            outputs = variants.setdefault(src, [])
+            if self.vanilla:
+                copies.append((src, dst))
+            else:
+                outputs.append(ImageVariant(dst, "jpeg", self.max_file_size, self.max_img_size))
+            for width, path in self.responsive(src, dst):
+                outputs.append(ImageVariant(path, "jpeg", self.max_file_size, (width, None)))
+            for fmt, max_file_size in self.formats.items():
+                outputs.append(ImageVariant(dst.with_suffix("." + fmt), fmt, max_file_size, self.max_img_size))
+                for width, path in self.responsive(src, dst, fmt):
+                    outputs.append(ImageVariant(path, fmt, max_file_size, (width, None)))
+        for src, dst in self.thumbs.items():
+            outputs = variants.setdefault(src, [])
+            outputs.append(ImageVariant(dst, "jpeg", None, self.max_thumb_size))
+            for fmt in self.formats:
+                outputs.append(ImageVariant(dst.with_suffix("." + fmt), fmt, None, self.max_thumb_size))
+        self._do_copy_vanilla(copies)
+        self._do_copy_convert(variants)
+        if self.staging is not None:
+            shutil.rmtree(self.staging, ignore_errors=True)
+    
+    def _full_width(self, source, fmt="jpeg"):
+        size = self.output_size(source, self.max_size(fmt))
+        return size[0] if size is not None else None
+    
+    def responsive(self, source, destination, fmt="jpeg"):
+        # Responsive variants narrower than the full size image. Without its
+        # size, srcset lists none of them: none is made
+        max_w = self._full_width(source, fmt)
+        if max_w is None:
+            return []
+        return [
+            (width, variant_path(destination, width, fmt))
+            for width in self.responsive_widths
+            if width < max_w
+        ]
+    
+    def srcset(self, path, fmt="jpeg"):
+        source = self.source(path)
+        full_width = self._full_width(source, fmt)
+        if source not in self.images or full_width is None:
+            return []
+        destination = self.images[source]
+        if fmt != "jpeg":
+            destination = destination.with_suffix("." + fmt)
+        return [
+            (variant, width) for width, variant in self.responsive(source, destination, fmt)
+        ] + [(destination, full_width)]
+    
+    def alternatives(self, path):
+        # Converted formats other than JPEG, best compression first
+        source = self.source(path)
+        if source not in self.images:
+            return []
+        destination = self.images[source]
+        return [
+            (MIME_TYPES[fmt], destination.with_suffix("." + fmt), self.srcset(path, fmt))
+            for fmt in self.formats
+        ]
+    
+    def _is_fresh(self, src, dst, params):
+        if self.manifest is None:
+            return False
+        if self.manifest.is_fresh(dst, [src], params):
+            self.manifest.keep(dst)
+            return True
+        return False
+    
+    def _record(self, src, dst, params):
+        if self.manifest is not None:
+            self.manifest.record(dst, [src], params)
+    
+    def _cache_key(self, src, params):
+        return self.cache.key(src, params)
+    
+    def _staged(self, dst):
+        if self.staging is None:
+            return dst
+        return self.staging / self.backend.name(dst)
+    
+    def _converted(self, src, dst, params):
+        staged = self._staged(dst)
+        if self.cache is not None:
+            self.cache.store(self._cache_key(src, params), staged)
+        self._record(src, dst, params)
+        if self.profiler.enabled:
+            self.profiler.count("image bytes written", staged.stat().st_size)
+        if staged != dst:
+            self.backend.copy(staged, dst, link=True)
+            staged.unlink()
+    
+    def _do_copy_vanilla(self, copies):
+        if not copies:
+            return
+        for src, dst in tqdm(copies, desc="Copying images"):
+            if self._is_fresh(src, dst, None):
+                continue
+            self.backend.copy(src, dst)
+            self._record(src, dst, None)
+    
+    def _do_copy_convert(self, variants):
+        jobs = []
+        for src, outputs in variants.items():
+            todo = []
+            for variant in outputs:
+                params = variant.params()
+                if self._is_fresh(src, variant.dst, params):
+                    self.profiler.count("images up to date")
+                    continue
+                if self.cache is not None and self.cache.fetch(self._cache_key(src, params), variant.dst, self.backend):
+                    self.profiler.count("image cache hits")
+                    self._record(src, variant.dst, params)
+                    continue
+                self.profiler.count("image cache misses")
+                todo.append(variant)
+            if todo:
+                jobs.append((src, todo))
+        # The workers write the conversions themselves
+        staged = {
+            src: [variant._replace(dst=self._staged(variant.dst)) for variant in todo]
+            for src, todo in jobs
+        }
+        failures = []
+        desc = "Converting images"
+        if self.workers == 1 or len(jobs) <= 1:
+            for src, todo in tqdm(jobs, desc=desc):
+                try:
+                    result = self._do_convert(src, staged[src], self.profiler.enabled)
+                except Exception as err:
+                    failures.append((src, err))
+                else:
+                    self._converted_all(src, todo, result, failures)
         else:
-            self._do_copy_convert()
-        self._do_copy_thumbs()
-    
-    def _do_copy_vanilla(self):
-        for src, dst in tqdm(self.images.items(), desc="Copying images"):
-            dst.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src, dst)
-            
-    
-    def _do_copy_convert(self):
-        for src, dst in tqdm(self.images.items(), desc="Converting images"):
-            self._do_convert(src, dst, self.max_file_size, self.max_img_size)
-    
-    def _do_copy_thumbs(self):
-        for src, dst in tqdm(self.thumbs.items(), desc="Creating thumbs"):
-            self._do_convert(src, dst, None, self.max_thumb_size)
-        
-    def _do_convert(self, src, dst, max_file_size, max_img_size):
-        dst.parent.mkdir(parents=True, exist_ok=True)
-        with WandImage(filename=src) as img_src:
-            with img_src.clone() as img_dst:
-                img_dst.format = 'jpeg'
-                if max_file_size is not None:
-                    img_dst.options['jpeg:extent'] = max_file_size
-                if max_img_size is not None:
-                    w, h = img_dst.size
-                    mw, mh = max_img_size
-                    rww, rhw = mw, int(h * mw / w)
-                    rwh, rhh = int(w * mh / h), mh
-                    rw, rh = min(w, rww, rwh), min(h, rhw, rhh)
-                    if (rw < w) or (rh < h):
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = {
+                    pool.submit(self._do_convert, src, staged[src], self.profiler.enabled): (src, todo)
+                    for src, todo in jobs
+                }
+                for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                    src, todo = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as err:
+                        failures.append((src, err))
+                    else:
+                        self._converted_all(src, todo, result, failures)
+        for src, err in failures:
+            print("Error converting image {}: {}".format(src, err))
+        if failures:
+            print("Warning {} image(s) could not be converted".format(len(failures)))
+    
+    def _converted_all(self, src, variants, result, failures):
+        events, errors = result
+        self.profiler.update(events)
+        errors = dict(errors)
+        for index, variant in enumerate(variants):
+            if index in errors:
+                failures.append((variant.dst, errors[index]))
+            else:
+                self._converted(src, variant.dst, variant.params())
+    
+    @staticmethod
+    def _do_convert(src, variants, profile=False):
+        # Decode the source once and derive every requested variant from it.
+        # Runs in worker processes: timings, and the variants that failed
+        # by index, are returned to the caller
+        from wand.image import Image as WandImage
+        profiler = Profiler(profile)
+        errors = []
+        with profiler.span("image", src=src):
+            with profiler.span("image decode", src=src):
+                img_src = WandImage(filename=src)
+            with img_src:
+                for index, variant in enumerate(variants):
+                    # A format the encoder fails on only loses its own files
+                    try:
+                        ImageFolder._do_convert_variant(img_src, variant, profiler)
+                    except Exception as err:
+                        errors.append((index, str(err)))
+        return profiler.drain(), errors
+    
+    @staticmethod
+    def _do_convert_variant(img_src, variant, profiler):
+        with img_src.clone() as img_dst:
+            img_dst.format = variant.format
+            if variant.max_img_size is not None:
+                w, h = img_dst.size
+                rw, rh = fit_size((w, h), variant.max_img_size)
+                if (rw < w) or (rh < h):
+                    with profiler.span("image resize", dst=variant.dst):
                         img_dst.resize(rw, rh)
-                img_dst.save(filename=dst)
+            with profiler.span("image encode", dst=variant.dst):
+                if variant.max_file_size is not None:
+                    if variant.format == 'jpeg':
+                        img_dst.options['jpeg:extent'] = variant.max_file_size
+                    elif variant.format == 'webp':
+                        img_dst.options['webp:target-size'] = str(parse_size(variant.max_file_size))
+                    else:
+                        ImageFolder._fit_quality(img_dst, parse_size(variant.max_file_size))
+                blob = img_dst.make_blob()
+            with profiler.span("image write", dst=variant.dst):
+                write_if_changed(variant.dst, blob)
+    
+    @staticmethod
+    def _fit_quality(img, max_file_size):
+        # Highest quality whose encoding fits in max_file_size, for the
+        # formats ImageMagick has no size target for (AVIF)
+        low, high, best = 10, 90, 10
+        while low <= high:
+            quality = (low + high) // 2
+            img.compression_quality = quality
+            if len(img.make_blob()) <= max_file_size:
+                best, low = quality, quality + 1
+            else:
+                high = quality - 1
+        img.compression_quality = best
 
    
-class ImageProcessor(Treeprocessor):
-    def __init__(self, folder_name, folder, context):
-        self.folder_name = folder_name
-        self.folder = folder
-        self.context = context
-    
-    def run(self, root):
-        for img_tag in root.iter("img"):
-            src = img_tag.attrib.get("src")
-            if not src:
-                print("EMPTY TAG")
-                continue
-            new_src = self.folder.match(src, self.folder_name)
-            new_src_url = self.context.url_for_abs(new_src)
-            img_tag.attrib["src"] = new_src_url
-
-
-class ImageProcessorExtension(Extension):
-    def __init__(self, processor):
-        self.processor = processor
-    def extendMarkdown(self, md):
-        md.treeprocessors.register(self.processor, 'imgproc', 5)
-
-
 class PostContext:
     def __init__(self, output_root, assets_root, filepath):
         self.output_root = pathlib.PurePosixPath(output_root)
@@ -185,21 +1302,577 @@ class PostContext:
         return posixpath.relpath(url_with_root, self.filepath.parent)
 
 
-class TplEnvironment(Environment):
-    def __init__(self, template_path, post_context):
-        super().__init__(
-            loader=FileSystemLoader(template_path),
-            autoescape=True
+CSS_STRING_OR_COMMENT = re.compile(r"""("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/""", re.S)
+
+
+def _minify_css_code(text):
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    # Only after the colon: a space before it is meaningful in selectors
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}")
+
+
+def minify_css(text):
+    # Comments are dropped and the code between the string literals is
+    # minified, the strings (content, font names, urls) are kept as they are
+    parts = []
+    code = []
+    last = 0
+    for match in CSS_STRING_OR_COMMENT.finditer(text):
+        code.append(text[last:match.start()])
+        last = match.end()
+        if match.group(1) is None:
+            code.append(" ")
+            continue
+        parts.append(_minify_css_code("".join(code)))
+        parts.append(match.group(1))
+        code = []
+    code.append(text[last:])
+    parts.append(_minify_css_code("".join(code)))
+    parts[0] = parts[0].lstrip()
+    parts[-1] = parts[-1].rstrip()
+    return "".join(parts)
+
+
+def minify_js(text):
+    # Conservative: indentation, blank lines and whole line comments only,
+    # newlines are kept for automatic semicolon insertion
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+class AssetPipeline:
+    HASH_LENGTH = 10
+    CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+    
+    def __init__(self, sources, output, bundles=None, fingerprint=True, minify=True, manifest=None, backend=None):
+        self.sources = [pathlib.Path(source) for source in sources]
+        self.output = pathlib.Path(output)
+        self.bundles = bundles or {}
+        self.fingerprint = fingerprint
+        self.minify = minify
+        self.manifest = manifest
+        self.backend = backend if backend is not None else FileBackend(output)
+        self.mapping = {}
+    
+    def files(self):
+        # Logical name -> source file, later sources override earlier ones
+        files = {}
+        for folder in self.sources:
+            for path in sorted(folder.rglob("*")):
+                if path.is_file():
+                    files[path.relative_to(folder).as_posix()] = path
+        return files
+    
+    def run(self, exclude=()):
+        files = {name: path for name, path in self.files().items() if name not in exclude}
+        bundled = {name for parts in self.bundles.values() for name in parts}
+        self.mapping = {}
+        # Plain files first: stylesheets are rewritten to their hashed names
+        for name, path in files.items():
+            if name in bundled or path.suffix in [".css", ".js"]:
+                continue
+            self.emit(name, path.read_bytes(), [path])
+        targets = {
+            name: [name] for name, path in files.items()
+            if path.suffix in [".css", ".js"] and name not in bundled
+        }
+        targets.update(self.bundles)
+        for name, parts in sorted(targets.items()):
+            missing = [part for part in parts if part not in files]
+            if missing:
+                print("Missing assets for {}: {}".format(name, ", ".join(missing)))
+            paths = [files[part] for part in parts if part in files]
+            texts = [
+                self._process(name, part, files[part].read_text(encoding="utf-8"))
+                for part in parts if part in files
+            ]
+            self.emit(name, "\n".join(texts).encode("utf-8"), paths)
+        return self.mapping
+    
+    def _process(self, name, part, text):
+        if part.endswith(".css"):
+            text = self._rewrite_urls(name, part, text)
+            return minify_css(text) if self.minify else text
+        if part.endswith(".js") and self.minify:
+            return minify_js(text)
+        return text
+    
+    def _rewrite_urls(self, name, part, text):
+        # url() are relative to the source file, the bundle may live elsewhere
+        def rewrite(match):
+            quote, url = match.groups()
+            if re.match(r"^([a-z]+:|/|#)", url):
+                return match.group(0)
+            path, sep, suffix = re.match(r"^([^?#]*)([?#]?)(.*)$", url).groups()
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(part), path))
+            target = self.mapping.get(target, target)
+            new_url = posixpath.relpath(target, posixpath.dirname(name) or ".")
+            return "url({0}{1}{2}{3}{0})".format(quote, new_url, sep, suffix)
+        return self.CSS_URL.sub(rewrite, text)
+    
+    def _hashed_name(self, name, data):
+        if not self.fingerprint:
+            return name
+        digest = hashlib.sha1(data).hexdigest()[:self.HASH_LENGTH]
+        base, ext = posixpath.splitext(name)
+        return "{}.{}{}".format(base, digest, ext)
+    
+    def emit(self, name, data, deps):
+        hashed = self._hashed_name(name, data)
+        dst = self.output / hashed
+        self.backend.write(dst, data)
+        if self.manifest is not None:
+            self.manifest.record(dst, deps)
+        self.mapping[name] = hashed
+
+
+class FontCache(DiskCache):
+    PAGES_FILE = "pages.json"
+    
+    def __init__(self, folder, max_size=None):
+        super().__init__(folder, max_size)
+        self._salt = None
+        # page -> [digest, characters], so that only changed pages are read
+        self.pages = {}
+        try:
+            with open(self.folder / self.PAGES_FILE, "r", encoding="utf-8") as fin:
+                data = json.load(fin)
+            if data.get("version") == self.API:
+                self.pages = data["pages"]
+        except (OSError, ValueError):
+            pass
+    
+    @property
+    def salt(self):
+        if self._salt is None:
+            import importlib.metadata
+            self._salt = json.dumps([
+                self.API,
+                importlib.metadata.version("fonttools") if _available("fontTools") else None,
+            ])
+        return self._salt
+    
+    def key(self, digest, text):
+        h = hashlib.sha256()
+        for part in (self.salt, digest, text):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+    
+    def save(self):
+        super().save()
+        save_json(self.folder / self.PAGES_FILE, {"version": self.API, "pages": self.pages})
+
+
+class FontSubsetter:
+    FONT_FACE = re.compile(r"@font-face\s*{([^}]*)}", re.S)
+    FONT_FAMILY = re.compile(r"font-family\s*:\s*([^;}<>]+)")
+    FONT = re.compile(r"font\s*:\s*([^;}<>]+)")
+    CONTENT = re.compile(r"""content\s*:\s*(['"])(.*?)\1""")
+    # Always kept, whatever the pages use
+    BASE_CHARS = "".join(chr(c) for c in range(0x20, 0x7f))
+    # Formats fontTools reads, in order of preference
+    SOURCE_SUFFIXES = [".ttf", ".otf", ".woff", ".woff2"]
+    
+    def __init__(self, stylesheet, output, assets, cache, digests, subset=True):
+        self.stylesheet = stylesheet
+        self.output = pathlib.Path(output)
+        self.assets = assets
+        self.cache = cache
+        self.digests = digests
+        self.subset = subset
+        self.profiler = Profiler()
+        self._faces = None
+    
+    def reset(self):
+        self._faces = None
+    
+    def faces(self):
+        # @font-face rules of the source stylesheet: family, other
+        # descriptors and the logical names of the font files
+        if self._faces is None:
+            self._faces = []
+            path = self.assets.files().get(self.stylesheet)
+            if path is None:
+                print("Missing font stylesheet {}".format(self.stylesheet))
+                return self._faces
+            text = re.sub(r"/\*.*?\*/", "", path.read_text(encoding="utf-8"), flags=re.S)
+            folder = posixpath.dirname(self.stylesheet)
+            for body in self.FONT_FACE.findall(text):
+                face = {"family": None, "descriptors": [], "sources": []}
+                for declaration in body.split(";"):
+                    name, _, value = declaration.partition(":")
+                    name, value = name.strip().lower(), value.strip()
+                    if not name:
+                        continue
+                    if name == "src":
+                        for _, url in AssetPipeline.CSS_URL.findall(value):
+                            url = re.split(r"[?#]", url)[0]
+                            source = posixpath.normpath(posixpath.join(folder, url))
+                            if source not in face["sources"]:
+                                face["sources"].append(source)
+                        continue
+                    if name == "font-family":
+                        face["family"] = value.strip("'\"")
+                    face["descriptors"].append("{}: {}".format(name, value))
+                if face["family"]:
+                    self._faces.append(face)
+        return self._faces
+    
+    def sources(self):
+        # What the asset stage must not copy: this stage replaces it
+        return [self.stylesheet] + [
+            source for face in self.faces() for source in face["sources"]
+        ]
+    
+    def used_families(self, texts):
+        families = set()
+        for text in texts:
+            text = self.FONT_FACE.sub("", text)
+            for value in self.FONT_FAMILY.findall(text):
+                families.update(self._family_names(value, shorthand=False))
+            for value in self.FONT.findall(text):
+                families.update(self._family_names(value, shorthand=True))
+        return families
+    
+    @staticmethod
+    def _family_names(value, shorthand):
+        for item in unescape(value).split(","):
+            item = item.strip()
+            quoted = re.match(r"""^.*?(['"])(.+)\1$""", item)
+            if quoted:
+                yield quoted.group(2).lower()
+            elif shorthand:
+                yield item.split()[-1].lower() if item else ""
+            else:
+                yield item.lower()
+    
+    def _page_chars(self, page):
+        backend = self.assets.backend
+        digest = backend.digest(page)
+        if digest is None:
+            return ""
+        cached = self.cache.pages.get(str(page))
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+        text = backend.read(page).decode("utf-8")
+        text = re.sub(r"<(script|style)\b.*?</\1>", " ", text, flags=re.S | re.I)
+        text = unescape(re.sub(r"<[^>]*>", " ", text))
+        chars = "".join(sorted(set(text) - set("\t\n\r\f\v")))
+        self.cache.pages[str(page)] = [digest, chars]
+        return chars
+    
+    def characters(self, pages, stylesheets):
+        chars = set(self.BASE_CHARS)
+        for page in pages:
+            chars.update(self._page_chars(page))
+        for text in stylesheets:
+            for _, content in self.CONTENT.findall(text):
+                chars.update(content)
+        # text-transform may show any page character in the other case
+        for char in list(chars):
+            chars.update(char.upper())
+            chars.update(char.lower())
+        names = {str(page) for page in pages}
+        self.cache.pages = {
+            page: entry for page, entry in self.cache.pages.items() if page in names
+        }
+        return "".join(sorted(chars))
+    
+    def run(self, pages, stylesheets, layouts=()):
+        # Families are looked for in the stylesheets and the inline styles
+        # of the layouts, characters in every rendered page
+        faces = self.faces()
+        if not faces:
+            return
+        files = self.assets.files()
+        styles = [self.assets.backend.read(path).decode("utf-8") for path in stylesheets]
+        pages = [pathlib.Path(page) for page in pages]
+        families = self.used_families(styles + [
+            pathlib.Path(layout).read_text(encoding="utf-8") for layout in layouts
+        ])
+        subset = self.subset and _available("fontTools") and _available("brotli")
+        if self.subset and not subset:
+            print("Warning fonts not subset: fontTools and brotli are not installed, copying the whole woff2 files")
+        text = self.characters(pages, styles) if subset else None
+        rules = []
+        for face in faces:
+            if face["family"].lower() not in families:
+                self.profiler.count("font faces dropped")
+                continue
+            url = self._woff2(face, files, text) if subset else self._copy_woff2(face, files)
+            if url is None:
+                continue
+            rules.append("@font-face {{\n    {};\n    src: url('{}') format('woff2');\n}}\n".format(
+                ";\n    ".join(face["descriptors"]),
+                pathlib.Path(os.path.relpath(self.assets.output / url, self.output.parent)).as_posix()
+            ))
+        css = "\n".join(rules)
+        if self.assets.minify:
+            css = minify_css(css)
+        self._emit(css.encode("utf-8"), [files[self.stylesheet]])
+        self.cache.save()
+    
+    def _emit(self, data, deps):
+        # Not fingerprinted: its subsets depend on the rendered pages, which
+        # link to it. So it lives outside the immutable assets folder, and is
+        # revalidated by the browsers
+        self.assets.backend.write(self.output, data)
+        if self.assets.manifest is not None:
+            self.assets.manifest.record(self.output, deps)
+    
+    def _copy_woff2(self, face, files):
+        for source in face["sources"]:
+            if source.endswith(".woff2") and source in files:
+                self.assets.emit(source, files[source].read_bytes(), [files[source]])
+                return self.assets.mapping[source]
+        print("No woff2 file for the font {}".format(face["family"]))
+        return None
+    
+    def _woff2(self, face, files, text):
+        candidates = [source for source in face["sources"] if source in files]
+        candidates.sort(key=lambda source: self._preference(source))
+        if not candidates:
+            print("No font file for the font {}".format(face["family"]))
+            return None
+        source = candidates[0]
+        path = files[source]
+        key = self.cache.key(str(self.digests.digest(path)), text)
+        data = self.cache.get_blob(key, ".woff2")
+        if data is None:
+            self.profiler.count("font subsets made")
+            with self.profiler.span("font subset", src=path):
+                data = self._make_subset(path, text)
+            self.cache.put_blob(key, data, ".woff2")
+        name = posixpath.splitext(source)[0] + ".woff2"
+        self.assets.emit(name, data, [path])
+        return self.assets.mapping[name]
+    
+    def _preference(self, source):
+        suffix = posixpath.splitext(source)[1]
+        return self.SOURCE_SUFFIXES.index(suffix) if suffix in self.SOURCE_SUFFIXES else len(self.SOURCE_SUFFIXES)
+    
+    @staticmethod
+    def _make_subset(path, text):
+        from fontTools import subset as font_subset
+        options = font_subset.Options()
+        options.flavor = "woff2"
+        options.layout_features = ["*"]
+        font = font_subset.load_font(str(path), options)
+        subsetter = font_subset.Subsetter(options)
+        subsetter.populate(text=text)
+        subsetter.subset(font)
+        buffer = io.BytesIO()
+        font_subset.save_font(font, buffer, options)
+        return buffer.getvalue()
+
+
+class SearchIndex:
+    # Inverted index of the posts for the client side search, sharded by
+    # term prefix. Posts are only indexed again when their source changed
+    API = "1.0"
+    CACHE_FILE = "search.json"
+    
+    def __init__(self, output, cache_folder, prefix_length=2, manifest=None, backend=None, fragments=None,
+                 docs_per_shard=256):
+        self.output = pathlib.Path(output)
+        self.backend = backend if backend is not None else FileBackend(output)
+        self.cache_path = pathlib.Path(cache_folder) / self.CACHE_FILE
+        self.prefix_length = prefix_length
+        self.docs_per_shard = docs_per_shard
+        self.manifest = manifest
+        self.fragments = fragments
+        self.profiler = Profiler()
+        self._markdown = None
+        self._salt = None
+        # url -> {"id", "digest", "title", "date", "terms"}, read on first run
+        self.documents = None
+    
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as fin:
+                data = json.load(fin)
+        except (OSError, ValueError):
+            return {}
+        return data["documents"] if data.get("salt") == self.salt else {}
+    
+    @property
+    def salt(self):
+        if self._salt is None:
+            import importlib.metadata
+            import site_search
+            self._salt = json.dumps([
+                self.API,
+                site_search.VERSION,
+                importlib.metadata.version("Markdown"),
+                importlib.metadata.version("typographeur"),
+            ])
+        return self._salt
+    
+    def run(self, bucket):
+        if self.documents is None:
+            self.documents = self._load()
+        digests = self.manifest.digests
+        documents = {}
+        for post in bucket:
+            digest = digests.digest(post.post.source)
+            document = self.documents.get(post.post.url)
+            if document is None or document["digest"] != digest:
+                self.profiler.count("search documents indexed")
+                with self.profiler.span("search document", src=post.post.source):
+                    document = self._document(post, digest)
+            documents[post.post.url] = document
+        self._assign_ids(documents)
+        self.documents = documents
+        self._write()
+        self.save()
+    
+    def _html(self, post):
+        # The post as Post._convert rendered it, kept by the fragment cache.
+        # Rendered again, without the images (they add no text), when the
+        # post was not converted in this build nor an earlier one
+        body = post.read_body()
+        if self.fragments is not None:
+            entry = self.fragments.get(self.fragments.key(body, post.folder_name(), post.post.url))
+            if entry is not None:
+                self.profiler.count("search fragment hits")
+                return entry["html"]
+        import markdown
+        from typographeur import typographeur
+        if self._markdown is None:
+            self._markdown = markdown.Markdown()
+        return typographeur(self._markdown.reset().convert(body))
+    
+    def _document(self, post, digest):
+        import site_search
+        html = self._html(post)
+        return {
+            "id": None,
+            "digest": digest,
+            "title": post.post.title,
+            "date": post.post.date.strftime("%Y-%m-%d") if post.post.date else None,
+            "terms": site_search.document_terms(post.post.title, post.post.description, html),
+        }
+    
+    @staticmethod
+    def _assign_ids(documents):
+        # Ids are kept from a build to the next, so that a post changing
+        # does not move the others in every shard
+        used = {doc["id"] for doc in documents.values() if doc["id"] is not None}
+        free = (i for i in itertools.count() if i not in used)
+        for url in sorted(documents):
+            if documents[url]["id"] is None:
+                documents[url]["id"] = next(free)
+    
+    def _write(self):
+        import site_search
+        # The titles of the results are sharded by id, so that a query only
+        # fetches the shards of the posts it found
+        docs = site_search.make_doc_shards(
+            {doc["id"]: [url, doc["title"], doc["date"]] for url, doc in self.documents.items()},
+            self.docs_per_shard
+        )
+        shards = site_search.make_shards(
+            {doc["id"]: doc["terms"] for doc in self.documents.values()},
+            self.prefix_length
         )
-        self.post_context = post_context
-        self.globals["url_for"] = self.url_for
-        self.globals["url_for_assets"] = self.url_for_assets
+        self._emit("index.json", {
+            "version": site_search.VERSION,
+            "prefix_length": self.prefix_length,
+            "docs_per_shard": self.docs_per_shard,
+            "stop_words": sorted(site_search.STOP_WORDS),
+            "shards": sorted(shards),
+        })
+        for number, shard in docs.items():
+            self._emit("docs/{}.json".format(number), shard)
+        for prefix, shard in shards.items():
+            self._emit("shards/{}.json".format(prefix), shard)
     
-    def url_for(self, url):
-        return self.post_context.url_for(url)
+    def _emit(self, name, data):
+        path = self.output / name
+        data = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        if self.backend.write(path, data.encode("utf-8")):
+            self.profiler.count("search files written")
+        if self.manifest is not None:
+            self.manifest.record(path, [])
     
-    def url_for_assets(self, url):
-        return self.post_context.url_for_assets(url)
+    def save(self):
+        save_json(self.cache_path, {"salt": self.salt, "documents": self.documents})
+
+
+class PostRecord:
+    # One entry of the post catalog: only what the index, the listings, the
+    # prev/next links and the render need. The other front matter keys are
+    # used by nothing, and not kept
+    TAXONOMIES = ("categories", "tags")
+    __slots__ = ("title", "description", "date", "date_event", "url",
+                 "source", "source_offset", "featured") + TAXONOMIES
+    
+    def __init__(self, title, description, date, date_event, url,
+                 source, source_offset=0, featured=None, categories=(), tags=()):
+        self.title = title
+        self.description = description
+        self.date = date
+        self.date_event = date_event
+        self.url = url
+        self.source = source
+        self.source_offset = source_offset
+        self.featured = featured
+        self.categories = categories
+        self.tags = tags
+    
+    @classmethod
+    def from_meta(cls, post_meta, url, source, source_offset=0):
+        featured = None
+        for resource in post_meta.get("resources", []):
+            if resource['name'] == "featuredImage":
+                # The whole resource, templates use its description
+                featured = copy.deepcopy(resource)
+                featured.setdefault("src", "")
+        return cls(
+            post_meta.get("title"),
+            post_meta.get("description"),
+            cls._parse_date(post_meta['date']),
+            post_meta.get("date_event"),
+            url,
+            str(source),
+            source_offset,
+            featured,
+            cls._terms(post_meta.get("categories")),
+            cls._terms(post_meta.get("tags"))
+        )
+    
+    @staticmethod
+    def _terms(value):
+        # A single term may be given without a list
+        if not value:
+            return ()
+        if isinstance(value, str):
+            return (value,)
+        return tuple(str(term) for term in value)
+    
+    @staticmethod
+    def _parse_date(value):
+        # A plain datetime is much lighter than pendulum's DateTime
+        import pendulum
+        date = pendulum.parse(value)
+        offset = date.utcoffset()
+        return datetime.datetime(
+            date.year, date.month, date.day,
+            date.hour, date.minute, date.second, date.microsecond,
+            tzinfo=datetime.timezone(offset) if offset is not None else None
+        )
+    
+    @property
+    def resources(self):
+        return {"featuredImage": self.featured} if self.featured is not None else {}
+    
+    def as_dict(self):
+        post = {key: getattr(self, key) for key in self.__slots__ if key != "featured"}
+        post["resources"] = self.resources
+        return post
 
 
 class Post:
@@ -207,38 +1880,124 @@ class Post:
         self.post = post
         self.prev = prev
         self.env = env
-    def write(self):
-        date = self.post.get('date_event')
+    
+    def dependencies(self):
+        deps = [self.post.source] + self.env.build_dependencies()
+        if self.prev:
+            deps.append(self.prev.source)
+        return deps
+    
+    def _convert(self, body, processor):
+        # markdown + typographeur, through the fragment cache
+        from typographeur import typographeur
+        fragments = self.env.fragments
+        key = fragments.key(body, processor.folder_name, self.post.url)
+        profiler = self.env.profiler
+        entry = fragments.get(key)
+        if entry is not None:
+            # Only valid if the images are rewritten as they were then
+            checkpoint = self.env.folder.checkpoint(entry["sources"], processor.folder_name)
+            if processor.replay(entry["sources"]) == entry["mapping"]:
+                profiler.count("fragment cache hits")
+                return entry["html"]
+            self.env.folder.rollback(checkpoint)
+            processor.retarget(processor.folder_name, processor.context)
+        profiler.count("fragment cache misses")
+        with profiler.span("markdown"):
+            content = self.env.markdown.reset().convert(body)
+        with profiler.span("typographeur"):
+            typo_content = typographeur(content)
+        fragments.put(key, {
+            "sources": processor.sources,
+            "mapping": processor.mapping(),
+            "html": typo_content,
+        })
+        return typo_content
+    
+    def read_body(self):
+        with open(self.post.source, "rb") as fin:
+            fin.seek(self.post.source_offset)
+            return fin.read().decode("utf-8").strip()
+    
+    def folder_name(self):
+        date = self.post.date_event
         if not date:
-            date = self.post.get('date').strftime("%Y-%m-%d") if self.post.get('date') else None
-        post = frontmatter.load(self.post.get('source'))
-        context = self.env.make_context(self.post.get('target'))
-        folder_name = "{}-{}".format(date, slugify(self.post.get('title')))
-        content = markdown.markdown(
-            post.content,
-            extensions=[
-                ImageProcessorExtension(
-                    ImageProcessor(
-                        folder_name,
-                        self.env.folder,
-                        context
-                    )
-                )
-            ]
-        )
-        typo_content = typographeur(content)
-        tpl = self.env.make_tpl_env(context)
-        single_tpl = tpl.get_template(self.env.SINGLE_TPL)
-        # Shallow copy "post" so that "content" is not added to bucket
+            date = self.post.date.strftime("%Y-%m-%d") if self.post.date else None
+        return "{}-{}".format(date, slugify(self.post.title))
+    
+    @property
+    def target(self):
+        return self.env.path("output") / self.post.url
+    
+    @property
+    def slug(self):
+        return pathlib.PurePosixPath(self.post.url).stem
+    
+    def write(self):
+        with self.env.profiler.span("post", url=self.post.url):
+            self._write()
+    
+    def register_images(self):
+        # Only what the image stage needs: no template, no page written
+        with self.env.profiler.span("post", url=self.post.url):
+            self._write(render=False)
+    
+    def _write(self, render=True):
+        profiler = self.env.profiler
+        folder_name = self.folder_name()
+        target = self.target
+        manifest = self.env.manifest
+        deps = self.dependencies()
+        if render:
+            import site_markdown
+            params = {
+                **self.env.page_params(),
+                "featured": self.env.featured_params([self.prev]),
+                "render": site_markdown.VERSION,
+            }
+        else:
+            # The images do not depend on the assets of the page
+            params = (manifest.previous(target) or {}).get("params")
+        context = self.env.make_context(target)
+        processor = self.env.image_processor
+        processor.retarget(folder_name, context)
+        if manifest.is_fresh(target, deps, params):
+            # Register the images of the untouched post as the render would.
+            # Their names depend on the posts registered before this one, so
+            # the saved page is only valid if they resolve as they did then
+            previous = manifest.previous(target)
+            checkpoint = self.env.folder.checkpoint(previous["images"], folder_name)
+            if processor.replay(previous["images"]) == previous.get("mapping"):
+                manifest.keep(target)
+                profiler.count("posts up to date")
+                return
+            self.env.folder.rollback(checkpoint)
+            processor.retarget(folder_name, context)
+            profiler.count("posts with moved images")
+        with profiler.span("read body"):
+            body = self.read_body()
+        typo_content = self._convert(body, processor)
+        if not render:
+            return
+        sources = list(processor.sources)
+        with profiler.span("template load"):
+            single_tpl = self.env.tpl_env.get_template(self.env.SINGLE_TPL)
+        from markupsafe import Markup
+        # A throwaway dict so that "content" is not kept in the catalog
         data = {
-            "post": copy.copy(self.post),
+            "post": self.post.as_dict(),
             "prev": self.prev,
-            "site": self.env.get_config()
+            "site": self.env.get_config(),
+            "categories": PostIndex(self.env).links(self.post, "categories"),
+            "post_context": context
         }
-        data["post"]["content"] = markupsafe.Markup(typo_content)
-        self.post.get('target').parent.mkdir(parents=True, exist_ok=True)
-        with open(self.post.get('target'), "w", encoding="utf-8") as fout:
-            fout.write(single_tpl.render(**data))
+        data["post"]["content"] = Markup(typo_content)
+        with profiler.span("template render"):
+            html = single_tpl.render(**data)
+        with profiler.span("file write"):
+            self.env.write_page(target, html.encode("utf-8"))
+        deps.extend(self.env.folder.source(src) for src in sources)
+        manifest.record(target, deps, params, images=sources, mapping=processor.mapping())
 
 
 class PostBucket:
@@ -252,36 +2011,62 @@ class PostBucket:
         self._posts = []
         for filepath in content_path.rglob("*.md"):
             try:
-                post_meta = frontmatter.load(filepath)
+                with self.site_env.profiler.span("frontmatter load", source=filepath):
+                    post_meta, offset = self._load_cached(filepath)
             except Exception as err:
                 raise RuntimeError(str(filepath)) from err
-            post_dict = self._reshape_post_meta(post_meta)
-            post_dict["source"] = filepath
             p_target = self.site_env.path("posts") / (filepath.parent.name + ".html")
-            post_dict["target"] = p_target
-            post_dict["url"] = p_target.relative_to(self.site_env.path("output")).as_posix()
-            feat_img = post_dict["resources"].get("featuredImage")
+            post = PostRecord.from_meta(
+                post_meta,
+                p_target.relative_to(self.site_env.path("output")).as_posix(),
+                filepath,
+                offset
+            )
+            feat_img = post.featured
             if feat_img:
-                src = feat_img.get('src', '')
+                src = feat_img['src']
                 if src != '':
-                    new_src = self.site_env.folder.thumb(src, slugify(post_dict['title']))
+                    new_src = self.site_env.folder.thumb(src, slugify(post.title))
                     feat_img['src'] = new_src
-            self._posts.append(post_dict)
-        self._posts.sort(key=lambda x:x["date"], reverse=True)
+                    feat_img['sources'] = self.site_env.folder.thumb_sources(src)
+                    dimensions = self.site_env.folder.thumb_dimensions(src)
+                    if dimensions:
+                        feat_img['width'], feat_img['height'] = dimensions
+                    placeholder = self.site_env.folder.placeholder(src)
+                    if placeholder:
+                        feat_img['placeholder'] = placeholder
+            self._posts.append(post)
+        self._posts.sort(key=lambda x:x.date, reverse=True)
         return self
     
+    def _load_cached(self, filepath):
+        # The watch mode keeps the parsed front matters between builds
+        cache = self.site_env.post_cache
+        if cache is None:
+            return self._load(filepath)
+        st = filepath.stat()
+        key = (st.st_size, st.st_mtime_ns)
+        cached = cache.get(filepath)
+        if cached is None or cached[0] != key:
+            cached = cache[filepath] = (key,) + self._load(filepath)
+        return cached[1], cached[2]
+    
     @staticmethod
-    def _reshape_post_meta(post_meta):
-        post_dict = {
-            key: copy.deepcopy(post_meta.get(key))
-            for key in post_meta.keys()
-            if key not in ["resources", "date"]
-        }
-        post_dict["date"] = pendulum.parse(post_meta['date'])
-        post_dict["resources"] = {}
-        for resource in post_meta.get("resources", []):
-            post_dict["resources"][resource['name']] = copy.deepcopy(resource)
-        return post_dict
+    def _load(filepath):
+        # Read and parse the front matter once, and remember where the body
+        # starts so that Post.write can read it without parsing YAML again
+        with open(filepath, "rb") as fin:
+            raw = fin.read()
+        import frontmatter
+        text = raw.decode("utf-8")
+        post_meta, content = frontmatter.parse(text)
+        # The body is the tail of the stripped text, as frontmatter sees it:
+        # with \r\n replaced by \n. Walk the same characters in the file
+        head = len(text.replace("\r\n", "\n").strip()) - len(content)
+        start = len(text) - len(text.lstrip())
+        for _ in range(head):
+            start += 2 if text.startswith("\r\n", start) else 1
+        return post_meta, len(text[:start].encode("utf-8"))
     
     def __iter__(self):
         posts, prevs = itertools.tee(self._posts, 2)
@@ -289,8 +2074,88 @@ class PostBucket:
         for post, prev in itertools.zip_longest(posts, prevs):
             yield Post(post, prev, env=self.site_env)
     
+    def records(self, start=0, stop=None):
+        # Catalog entries, newest first
+        return itertools.islice(self._posts, start, stop)
+    
     def __len__(self):
         return len(self._posts)
+    
+    def register_images(self):
+        for post in tqdm(self, desc="Reading posts"):
+            post.register_images()
+    
+    def write(self, workers=1, slug=None):
+        if slug is not None:
+            posts = [post for post in self if post.slug == slug]
+            if not posts:
+                print("No post {}".format(slug))
+            for post in posts:
+                post.write()
+            return
+        if workers <= 1 or len(self) <= 1:
+            for post in tqdm(self, desc="Writing posts"):
+                post.write()
+            return
+        env = self.site_env
+        posts = list(self)
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_render_worker,
+            initargs=(env.root, env.profiler.enabled, env.asset_urls, env.manifest.incremental)
+        ) as pool:
+            results = pool.map(
+                _render_post,
+                [(post.post, post.prev) for post in posts],
+                chunksize=max(1, len(posts) // (workers * 4))
+            )
+            for post, result in tqdm(zip(posts, results), total=len(posts), desc="Writing posts"):
+                env.manifest.digests.update(result["digests"])
+                if env.folder.cache is not None:
+                    env.folder.cache.update(result["cache"])
+                env.fragments.update(result["fragments"])
+                env.profiler.update(result["profile"])
+                sources = result["record"]["images"]
+                folder_name = post.folder_name()
+                if env.folder.is_independent(sources, folder_name):
+                    # Merge the registrations made by the worker
+                    for src in sources:
+                        env.folder.match(src, folder_name)
+                    env.manifest.records[str(post.target)] = result["record"]
+                    if result["page"] is not None:
+                        env.write_page(post.target, result["page"])
+                else:
+                    # An image is shared with a previous post: only a
+                    # serial render gives the same names as a serial build
+                    post.write()
+
+
+_render_env = None
+
+
+def _init_render_worker(root, profile=False, assets=None, incremental=None):
+    global _render_env
+    _render_env = SiteEnvironment(root, profile)
+    if incremental is not None:
+        _render_env.manifest.incremental = incremental
+    _render_env.deferred = {}
+    _render_env.set_assets(assets or {})
+
+
+def _render_post(args):
+    post, prev = args
+    env = _render_env
+    env.folder.reset()
+    post = Post(post, prev, env=env)
+    post.write()
+    return {
+        "record": env.manifest.records.pop(str(post.target)),
+        "page": env.deferred.pop(str(post.target), None),
+        "digests": env.manifest.digests.drain(),
+        "cache": env.folder.cache.drain() if env.folder.cache is not None else {},
+        "fragments": env.fragments.drain(),
+        "profile": env.profiler.drain(),
+    }
 
 
 class SiteEnvironment:
@@ -299,10 +2164,25 @@ class SiteEnvironment:
     SINGLE_TPL = "single.html.j2"
     INDEX_TPL = "index.html.j2"
     
-    def __init__(self, root):
+    def __init__(self, root, profile=False, package=None):
         self.root = pathlib.Path(root).resolve()
+        self.profiler = Profiler(profile)
+        self._build_deps = None
+        self.deferred = None
+        self.assets_version = None
+        self.post_cache = None
+        # Logical asset name -> fingerprinted name, shared with the templates
+        self.asset_urls = {}
+        self._tpl_env = None
+        self._markdown = None
         self._read_config()
+        self._make_manifest()
+        self._make_backend(package)
         self._make_image_folder()
+        self._make_fragment_cache()
+        self._make_assets()
+        self._make_fonts()
+        self._make_search()
     
     def _read_config(self):
         p_config = self.root / self.CONFIG_FILE
@@ -321,6 +2201,21 @@ class SiteEnvironment:
         self._path["posts"] = self._path["site"] / "posts"
         self._path["assets"] = self._path["site"] / "assets"
         self._path["metadata"] = (self.root / self.config("photos.metadata")).resolve()
+        self._path["cache"] = (self.root / self.config("build.cache", ".cache")).resolve()
+        self._path["deploy"] = (self.root / self.config("build.deploy_manifest", "deploy.json")).resolve()
+    
+    def _make_manifest(self):
+        self.manifest = BuildManifest.load(
+            self.path("cache") / "manifest.json",
+            self.config("build.incremental", False)
+        )
+    
+    def _make_backend(self, package):
+        self.backend = make_backend(package, self.path("output"), self.manifest.digests)
+        if not self.backend.in_place:
+            # Outputs of a previous build cannot be kept: render everything,
+            # the image and fragment caches still apply
+            self.manifest.incremental = False
     
     def _make_image_folder(self):
         if self.config("photos.highres"):
@@ -329,15 +2224,29 @@ class SiteEnvironment:
         else:
             max_img_size = self.config("photos.max_img_size", None)
             max_file_size = self.config("photos.max_file_size", None)
-            max_thumb_size = self.config("photos.max_thumb_size", (400, 300))
         self.folder = ImageFolder.make(
             self.path("metadata"),
             self.path("photos"),
             self.path("assets"),
-            max_img_size,
-            max_file_size,
-            max_thumb_size
+            max_img_size=max_img_size,
+            max_file_size=max_file_size,
+            # Thumbnails are resized in high resolution mode too
+            max_thumb_size=self.config("photos.max_thumb_size", (400, 300)),
+            manifest=self.manifest,
+            workers=self.config("photos.workers", None),
+            cache=ImageCache(
+                self.path("cache") / "images",
+                self.config("photos.derived_cache_size", None),
+                self.manifest.digests
+            ),
+            responsive_widths=self.config("photos.responsive_widths", []),
+            sizes=self.config("photos.sizes", None),
+            formats=self.config("photos.formats", {}),
+            placeholders=self.config("photos.placeholders", False),
+            backend=self.backend,
+            staging=None if self.backend.in_place else self.path("cache") / "staging"
         )
+        self.folder.profiler = self.profiler
     
     def config(self, key, default=KeyError):
         base = self._config
@@ -357,6 +2266,35 @@ class SiteEnvironment:
     def get_config(self):
         return self._config
     
+    def build_dependencies(self):
+        # Inputs shared by every rendered page. The image bank is not one of
+        # them: pages record the images they show in their params instead
+        if self._build_deps is None:
+            self._build_deps = self.layouts() + [self.root / self.CONFIG_FILE]
+        return list(self._build_deps)
+    
+    def reset(self):
+        # Prepare a resident environment for another build
+        self.manifest.restart()
+        self.folder.reset()
+        self._build_deps = None
+        if self.fonts is not None:
+            self.fonts.reset()
+    
+    def layouts(self):
+        layouts = self.path("template") / "layouts"
+        return sorted(p for p in layouts.rglob("*") if p.is_file())
+    
+    def write_page(self, path, data):
+        if self.deferred is not None:
+            # Render workers leave the write to the parent process
+            self.deferred[str(path)] = data
+            return
+        if not self.backend.write(path, data):
+            self.profiler.count("pages unchanged")
+        if self.profiler.enabled:
+            self.profiler.count("page bytes written", len(data))
+    
     def make_context(self, filepath):
         return PostContext(
             self.path("output"),
@@ -364,75 +2302,601 @@ class SiteEnvironment:
             filepath
         )
     
-    def make_tpl_env(self, context):
-        return TplEnvironment(
-            self.path("template") / "layouts",
-            context
+    def _make_markdown(self):
+        # Created on first use: only the stages rendering posts need it
+        if self._markdown is None:
+            import markdown
+            from site_markdown import ImageProcessor, ImageProcessorExtension
+            self._image_processor = ImageProcessor(None, self.folder, None)
+            self._markdown = markdown.Markdown(
+                extensions=[ImageProcessorExtension(self._image_processor)]
+            )
+    
+    @property
+    def markdown(self):
+        self._make_markdown()
+        return self._markdown
+    
+    @property
+    def image_processor(self):
+        self._make_markdown()
+        return self._image_processor
+    
+    def _make_fragment_cache(self):
+        self.fragments = FragmentCache(
+            self.path("cache") / "fragments",
+            self.config("build.fragment_cache_size", None)
         )
     
+    @property
+    def tpl_env(self):
+        if self._tpl_env is None:
+            from site_templates import TplEnvironment
+            self._tpl_env = TplEnvironment(
+                self.path("template") / "layouts",
+                self.path("cache") / "jinja",
+                self.asset_urls
+            )
+        return self._tpl_env
+    
+    def _make_assets(self):
+        self.assets = AssetPipeline(
+            [self.path("template") / source for source in self.config("assets.sources", [])],
+            self.path("assets"),
+            self.config("assets.bundles", {}),
+            self.config("assets.fingerprint", True),
+            self.config("assets.minify", True),
+            self.manifest,
+            self.backend
+        )
+    
+    def _make_fonts(self):
+        self.fonts = None
+        if self.config("fonts.stylesheet", None) is not None:
+            self.fonts = FontSubsetter(
+                self.config("fonts.stylesheet"),
+                self.path("output") / self.config("fonts.output", "fonts.css"),
+                self.assets,
+                FontCache(self.path("cache") / "fonts"),
+                self.manifest.digests,
+                self.config("fonts.subset", True)
+            )
+            self.fonts.profiler = self.profiler
+    
+    def _make_search(self):
+        self.search = None
+        if self.config("search", None) is not None:
+            self.search = SearchIndex(
+                self.path("output") / self.config("search.output", "search"),
+                self.path("cache"),
+                self.config("search.prefix_length", 2),
+                self.manifest,
+                self.backend,
+                self.fragments,
+                self.config("search.docs_per_shard", 256)
+            )
+            self.search.profiler = self.profiler
+    
+    def set_assets(self, mapping):
+        self.asset_urls.clear()
+        self.asset_urls.update(mapping)
+        self.assets_version = hashlib.sha1(
+            json.dumps(mapping, sort_keys=True).encode()
+        ).hexdigest()
+    
+    def page_params(self):
+        # Pages embed the fingerprinted asset names
+        return {"assets": self.assets_version}
+    
+    @staticmethod
+    def featured_params(records):
+        # Featured images of the posts a page shows: thumbnail, sources,
+        # dimensions and placeholder. Digested, placeholders are long
+        data = json.dumps([post.featured if post else None for post in records], sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+    
     def get_post_bucket(self):
         return PostBucket.make(self)
 
 
 class PostIndex:
+    ARCHIVES_FOLDER = "archives"
+    
     def __init__(self, env):
         self.env = env
-        
-    def _post_index_path(self, nb_pages):
-        yield self.env.path("output") / self.env.config("home.url")
+        self.posts_per_page = env.config("posts_per_page", 8)
+        # Only the taxonomies the post records keep
+        self.taxonomies = [
+            taxonomy for taxonomy in env.config("listings.taxonomies", PostRecord.TAXONOMIES)
+            if taxonomy in PostRecord.TAXONOMIES
+        ]
+    
+    def _post_index_path(self, first, folder, nb_pages):
+        yield first
         for i in range(nb_pages-1):
-            yield self.env.path("posts") / "page" / (str(i+2) + ".html")
-    def _index_pagination(self, nb_pages):
+            yield folder / "page" / (str(i+2) + ".html")
+    
+    def _index_pagination(self, first, folder, nb_pages):
         def make_pagination(n, p):
             return {
                 "next": ({"url": n.relative_to(self.env.path("output")).as_posix()} if n else None),
                 "prev": ({"url": p.relative_to(self.env.path("output")).as_posix()} if p else None)
             }
-        nxt, curr, prev = itertools.tee(self._post_index_path(nb_pages), 3)
+        nxt, curr, prev = itertools.tee(self._post_index_path(first, folder, nb_pages), 3)
         next(prev, None)
         yield next(curr), make_pagination(None, next(prev, None))
         for i in range(nb_pages-1):
             yield next(curr), make_pagination(next(nxt), next(prev, None))
     
+    def partition(self, bucket):
+        # One pass over the date sorted catalog fills every listing, each
+        # one staying sorted by date
+        archives = self.env.config("listings.archives", True)
+        listings = {}
+        for post in bucket.records():
+            keys = {}
+            for taxonomy in self.taxonomies:
+                for slug, title in self.terms(post, taxonomy):
+                    keys.setdefault((taxonomy, slug), title)
+            if archives and post.date:
+                keys[("year", post.date.strftime("%Y"))] = post.date.strftime("%Y")
+                keys[("month", post.date.strftime("%Y/%m"))] = post.date.strftime("%m/%Y")
+            for key, title in keys.items():
+                if key not in listings:
+                    listings[key] = ({"kind": key[0], "title": title}, [])
+                listings[key][1].append(post)
+        return listings
+    
+    @staticmethod
+    def terms(post, taxonomy):
+        # (slug, title) of the terms of a post. A term without any letter
+        # or digit has an empty slug, and so no listing
+        slugs = ((slugify(term), term) for term in getattr(post, taxonomy))
+        return [(slug, title) for slug, title in slugs if slug]
+    
+    def links(self, post, taxonomy):
+        # Listings of the terms of a post, for the links of its page
+        if taxonomy not in self.taxonomies:
+            return []
+        links = []
+        for slug, title in self.terms(post, taxonomy):
+            folder = self._listing_folder(taxonomy, slug)
+            url = folder.with_name(folder.name + ".html").relative_to(self.env.path("output"))
+            links.append({"title": title, "url": url.as_posix()})
+        return links
+    
+    def _listing_folder(self, kind, slug):
+        if kind in ["year", "month"]:
+            return self.env.path("posts") / self.ARCHIVES_FOLDER / slug
+        return self.env.path("posts") / kind / slug
+    
     def write(self, bucket):
-        posts_per_page =self.env.config("posts_per_page", 8)
-        nb_pages = math.ceil(len(bucket) / posts_per_page)
-        postit = iter(bucket)
-        for filepath, paginator in self._index_pagination(nb_pages):
+        unknown = set(self.env.config("listings.taxonomies", [])) - set(PostRecord.TAXONOMIES)
+        if unknown:
+            print("Unknown taxonomies {}, skipping".format(", ".join(sorted(unknown))))
+        index_tpl = self.env.tpl_env.get_template(self.env.INDEX_TPL)
+        self._write_listing(
+            index_tpl,
+            None,
+            self.env.path("output") / self.env.config("home.url"),
+            self.env.path("posts"),
+            len(bucket),
+            bucket.records()
+        )
+        with self.env.profiler.span("partition listings"):
+            listings = self.partition(bucket)
+        for (kind, slug), (listing, posts) in sorted(listings.items()):
+            folder = self._listing_folder(kind, slug)
+            self._write_listing(
+                index_tpl,
+                listing,
+                folder.with_name(folder.name + ".html"),
+                folder,
+                len(posts),
+                iter(posts)
+            )
+    
+    def _write_listing(self, index_tpl, listing, first, folder, nb_posts, postit):
+        nb_pages = math.ceil(nb_posts / self.posts_per_page)
+        manifest = self.env.manifest
+        for filepath, paginator in self._index_pagination(first, folder, nb_pages):
             data = {
                 "site": self.env.get_config(),
                 "paginator": paginator,
-                "posts": [post.post for post in itertools.islice(postit, 8)]
+                "listing": listing,
+                "posts": list(itertools.islice(postit, self.posts_per_page))
+            }
+            deps = [post.source for post in data["posts"]] + self.env.build_dependencies()
+            params = {
+                "paginator": paginator,
+                "posts": [post.url for post in data["posts"]],
+                "featured": self.env.featured_params(data["posts"]),
+                **self.env.page_params()
             }
-            ctx = self.env.make_context(filepath)
-            tpl = self.env.make_tpl_env(ctx)
-            index_tpl = tpl.get_template(self.env.INDEX_TPL)
-            filepath.parent.mkdir(parents=True, exist_ok=True)
-            with open(filepath, "w", encoding="utf-8") as fout:
-                fout.write(index_tpl.render(**data))
+            if listing is not None:
+                params["listing"] = listing
+            if manifest.is_fresh(filepath, deps, params):
+                manifest.keep(filepath)
+                continue
+            with self.env.profiler.span("index page", path=filepath):
+                ctx = self.env.make_context(filepath)
+                data["post_context"] = ctx
+                html = index_tpl.render(**data)
+                self.env.write_page(filepath, html.encode("utf-8"))
+            manifest.record(filepath, deps, params)
+
+
+PRECOMPRESSED_SUFFIXES = {"gzip": ".gz", "brotli": ".br"}
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    import brotli
+    return brotli.compress(data, quality=11)
+
+
+def _compress_all(path, encodings):
+    data = pathlib.Path(path).read_bytes()
+    return [_compress(data, encoding) for encoding in encodings]
+
+
+def _precompress(path, encodings):
+    # Runs in worker processes: returns the siblings and how many were written
+    path = pathlib.Path(path)
+    mtime = path.stat().st_mtime_ns
+    data = None
+    siblings = []
+    written = 0
+    for encoding in encodings:
+        sibling = path.with_name(path.name + PRECOMPRESSED_SUFFIXES[encoding])
+        siblings.append((encoding, sibling))
+        try:
+            if sibling.stat().st_mtime_ns >= mtime:
+                continue
+        except OSError:
+            pass
+        if data is None:
+            data = path.read_bytes()
+        blob = _compress(data, encoding)
+        if not write_if_changed(sibling, blob):
+            # Same bytes: mark the sibling as up to date with its source
+            os.utime(sibling)
+        written += 1
+    return siblings, written
+
+
+class Precompressor:
+    SUFFIXES = TEXT_SUFFIXES
+    
+    def __init__(self, encodings, workers=1, manifest=None, profiler=None, backend=None):
+        self.encodings = []
+        for encoding in encodings:
+            if encoding not in PRECOMPRESSED_SUFFIXES:
+                print("Unknown precompression {}, skipping".format(encoding))
+            elif encoding == "brotli" and not _available("brotli"):
+                print("brotli is not installed, skipping .br files")
+            else:
+                self.encodings.append(encoding)
+        self.workers = workers
+        self.manifest = manifest
+        self.profiler = profiler if profiler is not None else Profiler()
+        self.backend = backend if backend is not None else FileBackend(".")
+    
+    def outputs(self, paths):
+        # Text outputs of this build: files left over in the output folder
+        # are not in the manifest and stay uncompressed
+        return sorted(
+            str(path) for path in paths
+            if pathlib.Path(path).suffix in self.SUFFIXES and self.backend.exists(path)
+        )
+    
+    def run(self, paths):
+        if not self.encodings or not paths:
+            return
+        if self.backend.in_place:
+            function, args, done = _precompress, paths, self._done
+        else:
+            # Streamed outputs: the workers read the local copy of their content
+            function, args, done = _compress_all, [str(self.backend.local(path)) for path in paths], self._added
+        if self.workers == 1 or len(paths) <= 1:
+            results = (function(arg, self.encodings) for arg in args)
+            done(paths, results)
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = pool.map(
+                    function,
+                    args,
+                    itertools.repeat(self.encodings),
+                    chunksize=max(1, len(paths) // (self.workers * 4))
+                )
+                done(paths, results)
+    
+    def _added(self, paths, results):
+        for path, blobs in tqdm(zip(paths, results), total=len(paths), desc="Compressing"):
+            path = pathlib.Path(path)
+            for encoding, blob in zip(self.encodings, blobs):
+                sibling = path.with_name(path.name + PRECOMPRESSED_SUFFIXES[encoding])
+                self.backend.write(sibling, blob)
+                self.profiler.count("precompressed files written")
+                if self.manifest is not None:
+                    self.manifest.record(sibling, [path], {"encoding": encoding})
+    
+    def _done(self, paths, results):
+        for path, (siblings, written) in tqdm(zip(paths, results), total=len(paths), desc="Compressing"):
+            self.profiler.count("precompressed files written", written)
+            self.profiler.count("precompressed files up to date", len(siblings) - written)
+            if self.manifest is not None:
+                for encoding, sibling in siblings:
+                    self.manifest.record(sibling, [path], {"encoding": encoding})
+
+
+BUILD_STAGES = ["posts", "index", "images"]
+
+
+def build(env, prune=False, workers=None, stages=None, slug=None):
+    profiler = env.profiler
+    if workers is None:
+        workers = env.config("build.workers", 1)
+    stages = set(BUILD_STAGES if stages is None else stages)
+    if slug is not None:
+        stages.add("posts")
+    partial = stages != set(BUILD_STAGES) or slug is not None
+    pages = "posts" in stages or "index" in stages
+    if partial:
+        # The outputs of the skipped stages are still part of the site
+        env.manifest.carry_over()
+        if prune:
+            print("Pruning needs a full build, skipped")
+            prune = False
+
+    with profiler.span("load posts"):
+        bucket = env.get_post_bucket()
+
+    if pages:
+        with profiler.span("copy assets"):
+            env.set_assets(env.assets.run(env.fonts.sources() if env.fonts else ()))
+
+    if "posts" in stages:
+        with profiler.span("write posts"):
+            bucket.write(workers, slug)
+    elif "images" in stages:
+        with profiler.span("register images"):
+            bucket.register_images()
+
+    if "index" in stages:
+        with profiler.span("write index"):
+            pidx = PostIndex(env)
+            pidx.write(bucket)
+
+    if pages and env.search is not None:
+        with profiler.span("search index"):
+            env.search.run(bucket)
+
+    if pages and env.fonts is not None:
+        with profiler.span("subset fonts"):
+            env.fonts.run(
+                [page for page in env.manifest.records if page.endswith(".html")],
+                [
+                    env.path("assets") / name
+                    for name in env.asset_urls.values() if name.endswith(".css")
+                ],
+                env.layouts()
+            )
+
+    if "images" in stages:
+        with profiler.span("copy images"):
+            env.folder.do_copy()
+
+    with profiler.span("precompress"):
+        compressor = Precompressor(
+            env.config("build.precompress", []),
+            workers,
+            env.manifest,
+            profiler,
+            env.backend
+        )
+        compressor.run(compressor.outputs(list(env.manifest.records)))
+
+    if env.backend.in_place:
+        # Only the output folder is deployed from the manifest: a package
+        # leaves it, and so the manifest, as it was
+        with profiler.span("deploy manifest"):
+            deploy = DeployManifest.load(env.path("deploy"), env.path("output"))
+            deploy.update(env.manifest.records, env.backend)
+            if prune:
+                deploy.prune()
+            deploy.save()
+        print("Outputs: {} added, {} changed, {} removed, {} stale".format(
+            len(deploy.added), len(deploy.changed), len(deploy.removed), len(deploy.stale)
+        ))
+
+    env.backend.close()
+    env.fragments.save()
+    # Placeholders are cached by the page stages as well
+    if env.folder.cache is not None:
+        env.folder.cache.save()
+    if not env.backend.in_place:
+        env.manifest.keep_previous()
+    env.manifest.save()
+    return bucket
+
+
+class SiteWatcher:
+    def __init__(self, root, prune=False, interval=0.5):
+        self.root = pathlib.Path(root).resolve()
+        self.prune = prune
+        self.interval = interval
+        self.env = None
+    
+    def _make_env(self):
+        env = SiteEnvironment(self.root)
+        env.manifest.incremental = True
+        env.post_cache = {}
+        return env
+    
+    def _settings(self):
+        # Changing one of these reloads the whole environment
+        return {str(self.root / SiteEnvironment.CONFIG_FILE), str(self.env.path("metadata"))}
+    
+    def snapshot(self):
+        files = {}
+        paths = [pathlib.Path(p) for p in self._settings()]
+        for folder in [self.env.path("content"), self.env.path("template")]:
+            paths.extend(folder.rglob("*"))
+        for path in paths:
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            files[str(path)] = (st.st_size, st.st_mtime_ns)
+        return files
+    
+    def reload(self):
+        # A broken or half written configuration keeps the previous
+        # environment, and the server running
+        try:
+            env = self._make_env()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return False
+        self.env = env
+        return True
+    
+    def build(self):
+        start = time.perf_counter()
+        try:
+            # Serial: starting render workers costs more than a few posts
+            build(self.env, prune=self.prune, workers=1)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            return
+        print("Built in {:.2f} s".format(time.perf_counter() - start))
+    
+    def serve(self, port):
+        import functools
+        import http.server
+        
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+        
+        server = http.server.ThreadingHTTPServer(
+            ("localhost", port),
+            functools.partial(Handler, directory=str(self.env.path("output")))
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print("Serving {} on http://localhost:{}/".format(self.env.path("output"), port))
+        return server
+    
+    def run(self, port=8000):
+        self.env = self._make_env()
+        self.build()
+        server = self.serve(port)
+        before = self.snapshot()
+        reload = False
+        try:
+            while True:
+                time.sleep(self.interval)
+                after = self.snapshot()
+                if after == before:
+                    continue
+                # Wait for the editor to finish writing
+                while True:
+                    time.sleep(self.interval)
+                    latest = self.snapshot()
+                    if latest == after:
+                        break
+                    after = latest
+                changed = {
+                    path for path in before.keys() | after.keys()
+                    if before.get(path) != after.get(path)
+                }
+                before = after
+                if reload or changed & self._settings():
+                    print("Configuration changed, reloading")
+                    # Retried on the next change when it fails
+                    reload = not self.reload()
+                    if reload:
+                        continue
+                else:
+                    self.env.reset()
+                self.build()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
 
 
 def main():
-    import sys
-    import os.path
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the site")
+    parser.add_argument("path", help="path/to/site")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="build_profile.json",
+        metavar="TRACE",
+        help="record stage timings in a Chrome trace-event file (default: %(const)s)"
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="delete the outputs of the previous build that are no longer produced"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="rebuild on changes and serve the output on localhost"
+    )
+    parser.add_argument("--port", type=int, default=8000, help="port of the preview server")
+    parser.add_argument(
+        "--only",
+        metavar="STAGES",
+        help="comma separated stages to run, among {} (default: all)".format(", ".join(BUILD_STAGES))
+    )
+    parser.add_argument("--post", metavar="SLUG", help="write this post only (name of its folder)")
+    parser.add_argument(
+        "--package",
+        metavar="PATH",
+        help="stream the site into this archive (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz, .zip) "
+             "or, for any other path, a content-addressed folder, instead of the output folder"
+    )
+    args = parser.parse_args()
 
-    if len(sys.argv) != 2:
-        print("Usage: {} path/to/site".format(sys.argv[0]))
-        sys.exit(-1)
+    if args.package and (args.watch or args.only or args.post or args.prune):
+        parser.error("--package needs a full build, without --watch, --only, --post or --prune")
 
-    path = os.path.abspath(sys.argv[1])
+    stages = None
+    if args.only:
+        stages = args.only.split(",")
+        unknown = set(stages) - set(BUILD_STAGES)
+        if unknown:
+            parser.error("unknown stages: {}".format(", ".join(sorted(unknown))))
+    elif args.post:
+        stages = ["posts"]
 
-    env = SiteEnvironment(path)
+    path = os.path.abspath(args.path)
 
-    bucket = env.get_post_bucket()
+    if args.watch:
+        SiteWatcher(path, prune=args.prune).run(args.port)
+        return
 
-    for post in tqdm(bucket, desc="Writing posts"):
-        post.write()
+    env = SiteEnvironment(path, profile=args.profile is not None, package=args.package)
 
-    pidx = PostIndex(env)
-    pidx.write(bucket)
+    try:
+        build(env, prune=args.prune, stages=stages, slug=args.post)
+    except BaseException:
+        env.backend.abort()
+        raise
 
-    env.folder.do_copy()
+    if args.profile is not None:
+        env.profiler.save(args.profile)
+        env.profiler.summary()
+        print("Trace written to {}".format(args.profile))
 
 
 if __name__ == "__main__":
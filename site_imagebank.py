@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import os
+import json
+import pathlib
+import sqlite3
+
+
+def bank_key(path):
+    # "parent/name" of an image path, the key of the image bank
+    return "/".join(str(path).replace("\\", "/").rsplit("/", 2)[-2:])
+
+
+class ImageBank:
+    # Source and size of the downloaded photos, by bank_key. Read from the
+    # JSON written by photo_match.py, or queried lazily from its SQLite form
+    VERSION = 1
+    SUFFIXES = (".db", ".sqlite")
+    
+    def __init__(self, sources=None, sizes=None, database=None):
+        self.sources = sources
+        self.sizes = sizes
+        self.database = database
+        self._db = None
+        if database is not None:
+            self.sources = {}
+            self.sizes = {}
+    
+    @classmethod
+    def make(cls, metadatafile):
+        if pathlib.Path(metadatafile).suffix in cls.SUFFIXES:
+            return cls(database=metadatafile)
+        with open(metadatafile, "r", encoding="utf-8") as fin:
+            metadata = json.load(fin)
+        sources = {}
+        sizes = {}
+        for key, source, size in cls.entries(metadata["matches"]):
+            sources[key] = source
+            if size:
+                sizes[source] = size
+        return cls(sources, sizes)
+    
+    @staticmethod
+    def entries(matches):
+        for data in matches:
+            source = data["path_matched"] or data["path_target"]
+            size = data["size_matched"] if data["path_matched"] else data["size_target"]
+            yield bank_key(data["path_target"]), source, (size["w"], size["h"]) if size else None
+    
+    @classmethod
+    def write(cls, database, matches):
+        database = pathlib.Path(database)
+        tmp = database.with_name(".{}.{}.tmp".format(database.name, os.getpid()))
+        if tmp.exists():
+            tmp.unlink()
+        db = sqlite3.connect(str(tmp))
+        try:
+            db.execute(
+                "CREATE TABLE images (key TEXT PRIMARY KEY, source TEXT NOT NULL,"
+                " width INTEGER, height INTEGER) WITHOUT ROWID"
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+                (
+                    (key, source) + (size or (None, None))
+                    for key, source, size in cls.entries(matches)
+                )
+            )
+            db.execute("CREATE INDEX images_source ON images (source)")
+            db.execute("PRAGMA user_version = {:d}".format(cls.VERSION))
+            db.commit()
+        finally:
+            db.close()
+        os.replace(tmp, database)
+    
+    @classmethod
+    def convert(cls, metadatafile, database):
+        with open(metadatafile, "r", encoding="utf-8") as fin:
+            metadata = json.load(fin)
+        cls.write(database, metadata["matches"])
+    
+    def _query(self, sql, value):
+        if self._db is None:
+            uri = "{}?mode=ro".format(pathlib.Path(self.database).resolve().as_uri())
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != self.VERSION:
+                raise ValueError("{}: unsupported image bank version {}".format(self.database, version))
+        return self._db.execute(sql, (value,)).fetchone()
+    
+    def source(self, key):
+        if self.database is None or key in self.sources:
+            return self.sources.get(key)
+        row = self._query("SELECT source FROM images WHERE key = ?", key)
+        self.sources[key] = row[0] if row else None
+        return self.sources[key]
+    
+    def size(self, source):
+        if self.database is None or source in self.sizes:
+            return self.sizes.get(source)
+        row = self._query("SELECT width, height FROM images WHERE source = ? LIMIT 1", source)
+        self.sizes[source] = (row[0], row[1]) if row and row[0] is not None else None
+        return self.sizes[source]
+    
+    def __getstate__(self):
+        # Worker processes open their own connection
+        state = self.__dict__.copy()
+        state["_db"] = None
+        return state
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import json
+import hashlib
+from html import escape
+import xml.etree.ElementTree as etree
+
+from markdown.treeprocessors import Treeprocessor
+from markdown.extensions import Extension
+
+
+# Bumped when the rendered html changes, so that cached fragments and
+# pages are rendered again
+VERSION = 4
+
+PLACEHOLDER_STYLE = "background-size: cover; background-image: url({})"
+
+
+class ImageProcessor(Treeprocessor):
+    def __init__(self, folder_name, folder, context):
+        self.folder_name = folder_name
+        self.folder = folder
+        self.context = context
+        self.sources = []
+        self.rewrites = []
+    
+    def retarget(self, folder_name, context):
+        # Reuse the processor (and its Markdown instance) for the next post
+        self.folder_name = folder_name
+        self.context = context
+        self.sources = []
+        self.rewrites = []
+    
+    def run(self, root):
+        parents = {child: parent for parent in root.iter() for child in parent}
+        first = True
+        for img_tag in list(root.iter("img")):
+            src = img_tag.attrib.get("src")
+            if not src:
+                print("EMPTY TAG")
+                continue
+            attrib = dict(self.rewrite(src))
+            alternatives = attrib.pop("alternatives")
+            img_tag.attrib.update(attrib)
+            # The first image is likely above the fold
+            img_tag.attrib["loading"] = "eager" if first else "lazy"
+            first = False
+            img_tag.attrib["decoding"] = "async"
+            if alternatives and img_tag in parents:
+                self._wrap_picture(img_tag, parents[img_tag], alternatives)
+    
+    def rewrite(self, src):
+        # Registers the image and returns the attributes replacing its src
+        self.sources.append(src)
+        new_src = self.folder.match(src, self.folder_name)
+        attrib = {"src": self.context.url_for_abs(new_src)}
+        dimensions = self.folder.dimensions(src)
+        if dimensions:
+            attrib["width"], attrib["height"] = map(str, dimensions)
+        placeholder = self.folder.placeholder(src)
+        if placeholder:
+            attrib["style"] = PLACEHOLDER_STYLE.format(placeholder)
+        attrib.update(self._srcset(self.folder.srcset(src)))
+        attrib["alternatives"] = []
+        for mime_type, path, srcset in self.folder.alternatives(src):
+            source = {"type": mime_type}
+            if len(srcset) > 1:
+                source.update(self._srcset(srcset))
+            else:
+                source["srcset"] = self.context.url_for_abs(path)
+            attrib["alternatives"].append(source)
+        self.rewrites.append(attrib)
+        return attrib
+    
+    def replay(self, sources):
+        for src in sources:
+            self.rewrite(src)
+        return self.mapping()
+    
+    def mapping(self):
+        # Digest of every rewrite made for the current post
+        data = json.dumps(self.rewrites, sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+    
+    def _srcset(self, srcset):
+        attrib = {}
+        if len(srcset) > 1:
+            attrib["srcset"] = ", ".join(
+                "{} {}w".format(self.context.url_for_abs(path), width)
+                for path, width in srcset
+            )
+            if self.folder.sizes:
+                attrib["sizes"] = self.folder.sizes
+        return attrib
+    
+    def _wrap_picture(self, img_tag, parent, alternatives):
+        picture = etree.Element("picture")
+        # <source> is a void element, which the serializer would close: the
+        # tags go through the raw HTML stash instead
+        picture.text = self.md.htmlStash.store("".join(
+            "<source {}>".format(" ".join(
+                '{}="{}"'.format(name, escape(value)) for name, value in source.items()
+            ))
+            for source in alternatives
+        ))
+        index = list(parent).index(img_tag)
+        parent.remove(img_tag)
+        picture.append(img_tag)
+        picture.tail, img_tag.tail = img_tag.tail, None
+        parent.insert(index, picture)
+
+
+class ImageProcessorExtension(Extension):
+    def __init__(self, processor):
+        self.processor = processor
+    def extendMarkdown(self, md):
+        self.processor.md = md
+        md.treeprocessors.register(self.processor, 'imgproc', 5)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import re
+import unicodedata
+from html.parser import HTMLParser
+
+
+# Bumped when the terms change, so that cached documents are indexed again
+VERSION = 1
+
+# Accents removed: articles, pronouns, prepositions, auxiliaries and the
+# elided forms (l', qu', jusqu'...) split off by the apostrophe
+STOP_WORDS = frozenset("""
+a ai au aux avec avait c ce ces cet cette d dans de des du elle elles en est et
+etait ete etre eu eux il ils j je jusqu l la le les leur leurs lorsqu lui m ma
+mais me meme mes moi mon n ne nos notre nous on ont ou par pas pour puisqu qu
+quand que quel quelle qui s sa sans se ses si son sont sur t ta te tes toi ton
+tu un une vos votre vous y
+""".split())
+
+LIGATURES = str.maketrans({"œ": "oe", "æ": "ae", "ß": "ss"})
+WORD = re.compile(r"[a-z0-9]+")
+
+# Weight of a term found in each field of a post
+TITLE_WEIGHT = 4
+DESCRIPTION_WEIGHT = 2
+TEXT_WEIGHT = 1
+
+
+def fold(text):
+    # Lower case, ligatures expanded and accents removed
+    text = unicodedata.normalize("NFKD", text.lower().translate(LIGATURES))
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def stem(word):
+    # Light stemming, plurals only: "villes" and "ville", "jeux" and "jeu"
+    if len(word) > 3 and word[-1] in "sx" and word[-2] != word[-1]:
+        return word[:-1]
+    return word
+
+
+def terms(text):
+    return [
+        stem(word) for word in WORD.findall(fold(text))
+        if len(word) > 1 and word not in STOP_WORDS
+    ]
+
+
+class _TextExtractor(HTMLParser):
+    SKIPPED = {"script", "style"}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED:
+            self._skip += 1
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED and self._skip:
+            self._skip -= 1
+    
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_text(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return " ".join(parser.parts)
+
+
+def document_terms(title, description, html):
+    # term -> score of one post
+    scores = {}
+    fields = [
+        (title or "", TITLE_WEIGHT),
+        (description or "", DESCRIPTION_WEIGHT),
+        (html_text(html), TEXT_WEIGHT),
+    ]
+    for text, weight in fields:
+        for term in terms(text):
+            scores[term] = scores.get(term, 0) + weight
+    return scores
+
+
+def make_shards(documents, prefix_length):
+    # documents: id -> {term: score}. Each shard holds the terms sharing a
+    # prefix, and for each term the [id, score] of its posts, best first
+    shards = {}
+    for doc_id, scores in documents.items():
+        for term, score in scores.items():
+            postings = shards.setdefault(term[:prefix_length], {}).setdefault(term, [])
+            postings.append([doc_id, score])
+    for shard in shards.values():
+        for postings in shard.values():
+            postings.sort(key=lambda posting: (-posting[1], posting[0]))
+    return shards
+
+
+def make_doc_shards(docs, docs_per_shard):
+    # docs: id -> [url, title, date]. Shard n holds the ids from
+    # n * docs_per_shard, at their offset in the shard; free ids are null
+    shards = {}
+    for doc_id, doc in docs.items():
+        shard = shards.setdefault(doc_id // docs_per_shard, [])
+        offset = doc_id % docs_per_shard
+        shard.extend([None] * (offset + 1 - len(shard)))
+        shard[offset] = doc
+    return shards
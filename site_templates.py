@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import pathlib
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+try:
+    from jinja2 import pass_context
+except ImportError:
+    # Jinja2 < 3.0
+    from jinja2 import contextfunction as pass_context
+
+
+class TplEnvironment(Environment):
+    # Shared by every page: URLs are resolved against the "post_context"
+    # given at render time, so templates are compiled only once
+    def __init__(self, template_path, bytecode_cache_path=None, assets=None):
+        bytecode_cache = None
+        if bytecode_cache_path is not None:
+            pathlib.Path(bytecode_cache_path).mkdir(parents=True, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(str(bytecode_cache_path))
+        super().__init__(
+            loader=FileSystemLoader(str(template_path)),
+            autoescape=True,
+            bytecode_cache=bytecode_cache
+        )
+        self.globals["url_for"] = self.url_for
+        self.globals["url_for_assets"] = self.url_for_assets
+        # Logical asset name -> fingerprinted name, filled by the asset stage
+        self.assets = assets if assets is not None else {}
+    
+    @staticmethod
+    @pass_context
+    def url_for(context, url):
+        return context["post_context"].url_for(url)
+    
+    @staticmethod
+    @pass_context
+    def url_for_assets(context, url):
+        url = context.environment.assets.get(url.lstrip("/"), url)
+        return context["post_context"].url_for_assets(url)
@@ -0,0 +1,141 @@
+// Client side search over the files written by SearchIndex: terms are
+// normalized as in site_search.py, and only the shards of the typed
+// prefixes are fetched
+
+function searchFold(text) {
+    return text.toLowerCase()
+        .replace(/œ/g, "oe").replace(/æ/g, "ae").replace(/ß/g, "ss")
+        .normalize("NFKD").replace(/[\u0300-\u036f]/g, "");
+}
+
+function searchStem(word) {
+    var last = word[word.length - 1];
+    if (word.length > 3 && (last === "s" || last === "x") && word[word.length - 2] !== last) {
+        return word.slice(0, -1);
+    }
+    return word;
+}
+
+function searchTerms(text, stopWords) {
+    return (searchFold(text).match(/[a-z0-9]+/g) || [])
+        .filter(function (word) { return word.length > 1 && !stopWords.has(word); })
+        .map(searchStem);
+}
+
+function SiteSearch(form) {
+    this.base = form.dataset.index.replace(/\/?$/, "/");
+    this.root = form.dataset.root.replace(/\/?$/, "/");
+    this.files = {};
+}
+
+SiteSearch.prototype.load = function (name) {
+    if (!(name in this.files)) {
+        this.files[name] = fetch(this.base + name).then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.status + " " + name);
+            }
+            return response.json();
+        });
+    }
+    return this.files[name];
+};
+
+SiteSearch.prototype.termScores = function (index, term) {
+    // Posts with this term or with a word starting with it
+    var prefix = term.slice(0, index.prefix_length);
+    if (index.shards.indexOf(prefix) < 0) {
+        return Promise.resolve({});
+    }
+    return this.load("shards/" + prefix + ".json").then(function (shard) {
+        var scores = {};
+        Object.keys(shard).forEach(function (word) {
+            if (word.lastIndexOf(term, 0) !== 0) {
+                return;
+            }
+            var boost = word === term ? 2 : 1;
+            shard[word].forEach(function (posting) {
+                scores[posting[0]] = Math.max(scores[posting[0]] || 0, posting[1] * boost);
+            });
+        });
+        return scores;
+    });
+};
+
+SiteSearch.prototype.query = function (text, limit) {
+    var self = this;
+    return this.load("index.json").then(function (index) {
+        var terms = searchTerms(text, new Set(index.stop_words)).filter(function (term) {
+            return term.length >= index.prefix_length;
+        });
+        if (!terms.length) {
+            return [];
+        }
+        return Promise.all(terms.map(function (term) {
+            return self.termScores(index, term);
+        })).then(function (perTerm) {
+            // Every term has to match
+            var total = perTerm[0];
+            perTerm.slice(1).forEach(function (scores) {
+                Object.keys(total).forEach(function (id) {
+                    if (id in scores) {
+                        total[id] += scores[id];
+                    } else {
+                        delete total[id];
+                    }
+                });
+            });
+            var ids = Object.keys(total).sort(function (a, b) {
+                return total[b] - total[a] || a - b;
+            }).slice(0, limit || 20);
+            // Only the doc shards of the results are fetched
+            return Promise.all(ids.map(function (id) {
+                var shard = Math.floor(id / index.docs_per_shard);
+                return self.load("docs/" + shard + ".json").then(function (docs) {
+                    var doc = docs[id % index.docs_per_shard];
+                    return {url: self.root + doc[0], title: doc[1], date: doc[2]};
+                });
+            }));
+        });
+    });
+};
+
+function searchShow(list, results) {
+    list.textContent = "";
+    results.forEach(function (result) {
+        var item = document.createElement("li");
+        var link = document.createElement("a");
+        link.href = result.url;
+        link.textContent = result.title;
+        item.appendChild(link);
+        if (result.date) {
+            var date = document.createElement("time");
+            date.dateTime = result.date;
+            date.textContent = result.date;
+            item.appendChild(date);
+        }
+        list.appendChild(item);
+    });
+}
+
+document.querySelectorAll("form[data-index]").forEach(function (form) {
+    var search = new SiteSearch(form);
+    var input = form.querySelector("input");
+    var list = form.querySelector(".search-results");
+    var timer = null;
+    var latest = 0;
+    form.addEventListener("submit", function (event) {
+        event.preventDefault();
+    });
+    input.addEventListener("input", function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var request = ++latest;
+            search.query(input.value).then(function (results) {
+                // Answers can come back out of order
+                if (request === latest) {
+                    searchShow(list, results);
+                }
+            });
+        }, 150);
+    });
+});
@@ -0,0 +1,481 @@
+import datetime
+import gzip
+import json
+import pathlib
+import re
+import tarfile
+import time
+import types
+import zipfile
+
+import pytest
+import toml
+
+from site_constructor import (
+    BuildManifest, DeployManifest, DiskCache, FileBackend, FileDigests, FontCache, FontSubsetter,
+    ImageBank, ImageFolder, Post, PostBucket, PostIndex, PostRecord, Precompressor, Profiler,
+    SiteEnvironment, build, fit_size, make_backend, minify_css
+)
+
+
+def test_minify_css():
+    css = """
+    /* Header */
+    .nav > a ,
+    .nav b {
+        color: red;
+        margin: 0 auto;
+    }
+    """
+    assert minify_css(css) == ".nav>a,.nav b{color:red;margin:0 auto}"
+
+
+def test_minify_css_keeps_strings():
+    css = """
+    .crumb::before { content: " > "; }
+    .list::after { content: 'a, b;  c'; }
+    .comment::after { content: "/* not a comment */"; }
+    .escaped::after { content: "say \\"hi\\" /* here */"; }
+    """
+    assert minify_css(css) == (
+        '.crumb::before{content:" > "}'
+        ".list::after{content:'a, b;  c'}"
+        '.comment::after{content:"/* not a comment */"}'
+        '.escaped::after{content:"say \\"hi\\" /* here */"}'
+    )
+
+
+def test_minify_css_comment_between_strings():
+    assert minify_css('a{font-family:"A"/* x */, "B" ;}') == 'a{font-family:"A","B"}'
+
+
+def test_disk_cache_roundtrip(tmp_path):
+    cache = DiskCache(tmp_path, "1kb")
+    assert cache.get_blob("ab12", ".bin") is None
+    cache.put_blob("ab12", b"data", ".bin")
+    assert cache.get_blob("ab12", ".bin") == b"data"
+    assert list(tmp_path.glob("ab/.*.tmp")) == []
+    cache.save()
+    assert DiskCache(tmp_path, "1kb").get_blob("ab12", ".bin") == b"data"
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    cache = DiskCache(tmp_path, 250)
+    for key in ["aa01", "bb02", "cc03"]:
+        now[0] += 1
+        cache.put_blob(key, b"x" * 100)
+    # The oldest entry is used again, so the second one goes first
+    now[0] += 1
+    cache.get_blob("aa01")
+    cache.save()
+    assert sorted(cache.index) == ["aa01", "cc03"]
+    assert not (tmp_path / "bb" / "bb02").exists()
+    assert DiskCache(tmp_path).get_blob("aa01") == b"x" * 100
+
+
+def test_disk_cache_unbounded(tmp_path):
+    cache = DiskCache(tmp_path)
+    for key in ["aa01", "bb02"]:
+        cache.put_blob(key, b"x" * 100)
+    cache.save()
+    assert sorted(cache.index) == ["aa01", "bb02"]
+
+
+def test_interrupted_save_keeps_previous_state(tmp_path):
+    manifest = BuildManifest.load(tmp_path / "manifest.json", True)
+    manifest.save()
+    before = (tmp_path / "manifest.json").read_bytes()
+    # Fails in the middle of the dump
+    manifest.records["page.html"] = {"sources": object()}
+    with pytest.raises(TypeError):
+        manifest.save()
+    assert (tmp_path / "manifest.json").read_bytes() == before
+    assert list(tmp_path.glob(".*.tmp")) == []
+
+
+def make_manifest(tmp_path):
+    manifest = BuildManifest(tmp_path / "cache" / "manifest.json", incremental=True)
+    source = tmp_path / "post.md"
+    source.write_text("Hello")
+    target = tmp_path / "post.html"
+    target.write_text("<p>Hello</p>")
+    manifest.record(target, [source], {"assets": "v1"})
+    manifest.save()
+    return source, target
+
+
+def reload(tmp_path, incremental=True):
+    return BuildManifest.load(tmp_path / "cache" / "manifest.json", incremental)
+
+
+def test_manifest_fresh(tmp_path):
+    source, target = make_manifest(tmp_path)
+    assert reload(tmp_path).is_fresh(target, [source], {"assets": "v1"})
+    assert not reload(tmp_path, incremental=False).is_fresh(target, [source], {"assets": "v1"})
+
+
+def test_manifest_stale_on_changed_source(tmp_path):
+    source, target = make_manifest(tmp_path)
+    source.write_text("Hello, world")
+    assert not reload(tmp_path).is_fresh(target, [source], {"assets": "v1"})
+
+
+def test_manifest_stale_on_changed_params(tmp_path):
+    source, target = make_manifest(tmp_path)
+    assert not reload(tmp_path).is_fresh(target, [source], {"assets": "v2"})
+
+
+def test_manifest_stale_on_new_dependency(tmp_path):
+    source, target = make_manifest(tmp_path)
+    layout = tmp_path / "single.html.j2"
+    layout.write_text("{{ post }}")
+    assert not reload(tmp_path).is_fresh(target, [source, layout], {"assets": "v1"})
+
+
+def test_manifest_stale_on_missing_target(tmp_path):
+    source, target = make_manifest(tmp_path)
+    target.unlink()
+    assert not reload(tmp_path).is_fresh(target, [source], {"assets": "v1"})
+
+
+def test_manifest_keeps_fresh_outputs(tmp_path):
+    source, target = make_manifest(tmp_path)
+    manifest = reload(tmp_path)
+    manifest.keep(target)
+    manifest.save()
+    assert reload(tmp_path).is_fresh(target, [source], {"assets": "v1"})
+
+
+def deploy(tmp_path, outputs, prune=False):
+    root = tmp_path / "output"
+    for name, text in outputs.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    manifest = DeployManifest.load(tmp_path / "deploy.json", root)
+    manifest.update([root / name for name in outputs], FileDigests())
+    if prune:
+        manifest.prune()
+    manifest.save()
+    return manifest
+
+
+def test_deploy_manifest_delta(tmp_path):
+    deploy(tmp_path, {"index.html": "a", "site/posts/a.html": "a"})
+    manifest = deploy(tmp_path, {"index.html": "b", "site/posts/b.html": "b"})
+    assert manifest.added == ["site/posts/b.html"]
+    assert manifest.changed == ["index.html"]
+    assert manifest.removed == ["site/posts/a.html"]
+    assert manifest.stale == ["site/posts/a.html"]
+    # Not pruned: still on disk, and listed until a build prunes it
+    assert (tmp_path / "output" / "site" / "posts" / "a.html").exists()
+    manifest = deploy(tmp_path, {"index.html": "b", "site/posts/b.html": "b"})
+    assert manifest.removed == []
+    assert manifest.stale == ["site/posts/a.html"]
+
+
+def test_deploy_manifest_prune(tmp_path):
+    root = tmp_path / "output"
+    deploy(tmp_path, {"index.html": "a", "site/old/a.html": "a"})
+    (root / "unknown.txt").write_text("not an output")
+    manifest = deploy(tmp_path, {"index.html": "a"}, prune=True)
+    assert manifest.stale == []
+    assert not (root / "site").exists()
+    assert (root / "index.html").exists()
+    # Files that no build wrote are left alone
+    assert (root / "unknown.txt").exists()
+    assert DeployManifest.load(tmp_path / "deploy.json", root).stale == []
+
+
+POST = """---
+title: Été à Lyon
+date: "2020-07-14T10:00:00+02:00"
+categories: Voyage
+tags: [Lyon, Été]
+draft: false
+resources:
+  - name: featuredImage
+    src: /photos/2020/lyon.jpg
+    params:
+      description: Les quais
+---
+
+Premier paragraphe.
+
+Second paragraphe, avec un accent : à.
+"""
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_post_body_offset(tmp_path, newline):
+    path = tmp_path / "index.md"
+    path.write_bytes(POST.replace("\n", newline).encode("utf-8"))
+    meta, offset = PostBucket._load(path)
+    post = Post(PostRecord.from_meta(meta, "site/posts/lyon.html", path, offset))
+    assert post.read_body().replace("\r\n", "\n") == (
+        "Premier paragraphe.\n\nSecond paragraphe, avec un accent : à."
+    )
+
+
+def test_post_record_from_meta(tmp_path):
+    path = tmp_path / "index.md"
+    path.write_text(POST, encoding="utf-8")
+    meta, offset = PostBucket._load(path)
+    record = PostRecord.from_meta(meta, "site/posts/lyon.html", path, offset)
+    assert record.title == "Été à Lyon"
+    assert record.date == datetime.datetime(
+        2020, 7, 14, 10, tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+    )
+    assert record.categories == ("Voyage",)
+    assert record.tags == ("Lyon", "Été")
+    assert record.featured["src"] == "/photos/2020/lyon.jpg"
+    assert record.resources == {"featuredImage": record.featured}
+    post = record.as_dict()
+    assert post["url"] == "site/posts/lyon.html"
+    assert "draft" not in post
+
+
+def make_folder(tmp_path, sources, sizes=None, **kwargs):
+    folder = ImageFolder(tmp_path / "photos", tmp_path / "assets", **kwargs)
+    folder.image_bank = ImageBank(sources, sizes or {})
+    return folder
+
+
+@pytest.mark.parametrize("size, max_size, fitted", [
+    ((4000, 3000), (1600, 1600), (1600, 1200)),
+    ((3000, 4000), (1600, 1600), (1200, 1600)),
+    ((800, 600), (1600, 1600), (800, 600)),
+    ((4000, 3000), (None, 300), (400, 300)),
+    ((4000, 3000), (1000, None), (1000, 750)),
+])
+def test_fit_size(size, max_size, fitted):
+    assert fit_size(size, max_size) == fitted
+
+
+def test_srcset_lists_narrower_variants(tmp_path):
+    sources = {"post/a.jpg": "/photos/a.jpg"}
+    folder = make_folder(
+        tmp_path, sources, {"/photos/a.jpg": (4000, 3000)},
+        max_img_size=(1600, 1600), max_file_size="1mb", responsive_widths=[960, 480, 1600, 2000]
+    )
+    destination = folder.match("/old/post/a.jpg", "lyon")
+    assert folder.dimensions("/old/post/a.jpg") == (1600, 1200)
+    assert folder.srcset("/old/post/a.jpg") == [
+        (destination.with_name("001-480w.jpg"), 480),
+        (destination.with_name("001-960w.jpg"), 960),
+        (destination, 1600),
+    ]
+
+
+def test_srcset_without_size(tmp_path):
+    sources = {"post/a.jpg": "/photos/a.jpg"}
+    folder = make_folder(tmp_path, sources, max_img_size=(1600, 1600), responsive_widths=[480])
+    # Neither in the bank nor readable
+    folder.source_sizes["/photos/a.jpg"] = None
+    destination = folder.match("/old/post/a.jpg", "lyon")
+    assert folder.responsive("/photos/a.jpg", destination) == []
+    assert folder.srcset("/old/post/a.jpg") == []
+
+
+def test_thumb_names_follow_their_source(tmp_path):
+    photo = tmp_path / "lyon.jpg"
+    photo.write_bytes(b"first photo")
+    sources = {"post/a.jpg": str(photo)}
+    name = make_folder(tmp_path, sources).thumb("/old/post/a.jpg", "lyon")
+    assert re.fullmatch(r"img/lyon\.[0-9a-f]{10}\.jpg", name)
+    assert make_folder(tmp_path, sources).thumb("/old/post/a.jpg", "lyon") == name
+    photo.write_bytes(b"another photo")
+    assert make_folder(tmp_path, sources).thumb("/old/post/a.jpg", "lyon") != name
+    resized = make_folder(tmp_path, sources, max_thumb_size=(200, 150))
+    assert resized.thumb("/old/post/a.jpg", "lyon") != name
+
+
+def test_font_characters_cover_both_cases(tmp_path):
+    page = tmp_path / "page.html"
+    page.write_text("<p>Été <b>ça</b> straße</p>", encoding="utf-8")
+    assets = types.SimpleNamespace(backend=FileBackend(tmp_path))
+    subsetter = FontSubsetter("fonts.css", tmp_path, assets, FontCache(tmp_path / "cache"), FileDigests())
+    chars = subsetter.characters([page], ['a::after { content: "→é"; }'])
+    assert set("ÉéÇçSsß→") <= set(chars)
+
+
+def test_precompress_in_place(tmp_path):
+    page = tmp_path / "index.html"
+    page.write_bytes(b"<p>accueil</p>" * 100)
+    (tmp_path / "photo.jpg").write_bytes(b"\xff\xd8")
+    manifest = BuildManifest(tmp_path / "manifest.json")
+    compressor = Precompressor(["gzip", "zstd"], 1, manifest, Profiler(True), FileBackend(tmp_path))
+    assert compressor.encodings == ["gzip"]
+    paths = compressor.outputs([page, tmp_path / "photo.jpg", tmp_path / "gone.css"])
+    assert paths == [str(page)]
+    compressor.run(paths)
+    sibling = tmp_path / "index.html.gz"
+    assert gzip.decompress(sibling.read_bytes()) == page.read_bytes()
+    assert str(sibling) in manifest.records
+    # Siblings newer than their page are left alone
+    compressor.run(paths)
+    assert compressor.profiler.counters["precompressed files written"] == 1
+    assert compressor.profiler.counters["precompressed files up to date"] == 1
+
+
+def test_precompress_package(tmp_path):
+    root = tmp_path / "output"
+    backend = make_backend(tmp_path / "site.zip", root)
+    backend.write(root / "index.html", b"<p>accueil</p>")
+    compressor = Precompressor(["gzip"], workers=2, backend=backend)
+    compressor.run(compressor.outputs([root / "index.html"]))
+    backend.close()
+    files = read_package(tmp_path / "site.zip")
+    assert sorted(files) == ["index.html", "index.html.gz"]
+    assert gzip.decompress(files["index.html.gz"]) == b"<p>accueil</p>"
+
+
+SITE = {
+    "lang": "fr-fr", "title": "Site", "description": "Site", "brand": "Site", "posts_per_page": 2,
+    "home": {"url": "index.html", "title": "Accueil", "description": "Accueil", "bgimg": ""},
+    "paths": {"template": str(pathlib.Path(__file__).parent.parent / "template")},
+    "photos": {"metadata": "matcherdata.json", "highres": False},
+    "assets": {"sources": ["static", "assets"]},
+    "search": {"output": "search"},
+    "build": {"precompress": ["gzip"]},
+}
+
+POST_PAGE = """---
+title: "Billet {0}"
+date: "2020-01-0{0}"
+bgimg: ""
+resources:
+  - name: featuredImage
+    src: ""
+    description: "Image {0}"
+categories: ["cat{1}"]
+tags: ["tag{0}"]
+---
+Texte du billet numéro {0}, avec du **gras**.
+"""
+
+
+def make_site(root):
+    root.mkdir()
+    (root / SiteEnvironment.CONFIG_FILE).write_text(toml.dumps(SITE), encoding="utf-8")
+    (root / "matcherdata.json").write_text('{"matches": []}', encoding="utf-8")
+    for number in range(1, 6):
+        folder = root / "content" / "billet-{}".format(number)
+        folder.mkdir(parents=True)
+        (folder / "index.md").write_text(POST_PAGE.format(number, number % 2), encoding="utf-8")
+    return root
+
+
+def test_post_links_follow_dates(tmp_path):
+    bucket = SiteEnvironment(make_site(tmp_path / "site")).get_post_bucket()
+    assert [post.title for post in bucket.records()] == ["Billet {}".format(n) for n in range(5, 0, -1)]
+    # Each page links to the post before it
+    assert [post.prev.title if post.prev else None for post in bucket] == [
+        "Billet 4", "Billet 3", "Billet 2", "Billet 1", None
+    ]
+
+
+def test_listings_partition(tmp_path):
+    env = SiteEnvironment(make_site(tmp_path / "site"))
+    listings = PostIndex(env).partition(env.get_post_bucket())
+    titles = {key: [post.title for post in posts] for key, (_, posts) in listings.items()}
+    assert sorted(titles) == [
+        ("categories", "cat0"), ("categories", "cat1"), ("month", "2020/01"),
+        ("tags", "tag1"), ("tags", "tag2"), ("tags", "tag3"), ("tags", "tag4"), ("tags", "tag5"),
+        ("year", "2020"),
+    ]
+    assert titles[("categories", "cat1")] == ["Billet 5", "Billet 3", "Billet 1"]
+    assert titles[("year", "2020")] == ["Billet {}".format(n) for n in range(5, 0, -1)]
+    assert listings[("month", "2020/01")][0] == {"kind": "month", "title": "01/2020"}
+
+
+def test_listing_links(tmp_path):
+    env = SiteEnvironment(make_site(tmp_path / "site"))
+    index = PostIndex(env)
+    post = types.SimpleNamespace(categories=("Été", "!!"), tags=())
+    # A term without letters has no listing
+    assert index.links(post, "categories") == [
+        {"title": "Été", "url": "site/posts/categories/ete.html"}
+    ]
+    assert index.links(post, "series") == []
+
+
+def output_tree(root):
+    output = root / "output"
+    return {
+        path.relative_to(output).as_posix(): path.read_bytes()
+        for path in output.rglob("*") if path.is_file()
+    }
+
+
+def test_parallel_build_matches_serial(tmp_path):
+    pytest.importorskip("jinja2")
+    trees = []
+    for workers in (1, 2):
+        root = make_site(tmp_path / "site{}".format(workers))
+        build(SiteEnvironment(root), workers=workers)
+        trees.append(output_tree(root))
+    assert "site/posts/billet-3.html" in trees[0]
+    assert "site/posts/billet-3.html.gz" in trees[0]
+    assert trees[0] == trees[1]
+
+
+def test_file_backend_keeps_unchanged_files(tmp_path):
+    backend = make_backend(None, tmp_path)
+    assert backend.in_place
+    assert backend.write(tmp_path / "a.html", b"<p>a</p>")
+    assert not backend.write(tmp_path / "a.html", b"<p>a</p>")
+    assert backend.write(tmp_path / "a.html", b"<p>b</p>")
+    assert backend.read(tmp_path / "a.html") == b"<p>b</p>"
+    assert backend.exists(tmp_path / "a.html") and not backend.exists(tmp_path / "b.html")
+
+
+def read_package(package):
+    if package.suffix == ".zip":
+        with zipfile.ZipFile(package) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+    if package.suffix == ".gz":
+        with tarfile.open(package) as archive:
+            return {info.name: archive.extractfile(info).read() for info in archive}
+    index = json.loads((package / "index.json").read_text(encoding="utf-8"))
+    return {
+        name: (package / "blobs" / digest[:2] / digest).read_bytes()
+        for name, digest in index["files"].items()
+    }
+
+
+@pytest.mark.parametrize("package", ["site.tar.gz", "site.zip", "site"])
+def test_package_backend(tmp_path, package):
+    root = tmp_path / "output"
+    image = tmp_path / "photo.jpg"
+    image.write_bytes(b"\xff\xd8" * 1000)
+    backend = make_backend(tmp_path / "dist" / package, root)
+    assert not backend.in_place
+    assert backend.write(root / "index.html", b"<p>accueil</p>")
+    assert not backend.write(root / "index.html", b"<p>autre</p>")
+    backend.copy(image, root / "img" / "photo.jpg")
+    # Text outputs stay readable for the later stages, before the close
+    assert backend.read(root / "index.html") == b"<p>accueil</p>"
+    assert backend.exists(root / "img" / "photo.jpg")
+    assert not backend.exists(root / "missing.html")
+    assert backend.digest(tmp_path / "outside.html") is None
+    backend.close()
+    files = read_package(tmp_path / "dist" / package)
+    assert files == {"index.html": b"<p>accueil</p>", "img/photo.jpg": image.read_bytes()}
+    # Neither the temporary archive nor the spooled texts are left behind
+    assert sorted(path.name for path in (tmp_path / "dist").iterdir()) == [package]
+
+
+@pytest.mark.parametrize("package", ["site.tar.gz", "site.zip"])
+def test_archive_backend_abort(tmp_path, package):
+    backend = make_backend(tmp_path / "dist" / package, tmp_path / "output")
+    backend.write(tmp_path / "output" / "index.html", b"<p>accueil</p>")
+    backend.abort()
+    assert list((tmp_path / "dist").iterdir()) == []
+
+
+def test_unsupported_archive_compression(tmp_path):
+    with pytest.raises(ValueError):
+        make_backend(tmp_path / "site.tar.zst", tmp_path / "output")
@@ -0,0 +1,72 @@
+import json
+import pickle
+import sqlite3
+
+import pytest
+
+from site_imagebank import ImageBank, bank_key
+
+MATCHES = [
+    {
+        "path_target": "wp-content/2019/01/plage.jpg",
+        "path_matched": "/photos/2019/plage-originale.jpg",
+        "size_target": {"w": 800, "h": 600},
+        "size_matched": {"w": 4000, "h": 3000},
+    },
+    {
+        "path_target": "wp-content/2019/02/neige.jpg",
+        "path_matched": None,
+        "size_target": {"w": 640, "h": 480},
+        "size_matched": None,
+    },
+    {
+        "path_target": "wp-content/2019/03/nuit.jpg",
+        "path_matched": None,
+        "size_target": None,
+        "size_matched": None,
+    },
+]
+
+
+@pytest.fixture
+def banks(tmp_path):
+    metadata = tmp_path / "matcherdata.json"
+    metadata.write_text(json.dumps({"matches": MATCHES}), encoding="utf-8")
+    database = tmp_path / "matcherdata.db"
+    ImageBank.convert(metadata, database)
+    return ImageBank.make(metadata), ImageBank.make(database)
+
+
+def test_bank_key():
+    assert bank_key("a/b/2019/plage.jpg") == "2019/plage.jpg"
+    assert bank_key("C:\\photos\\2019\\plage.jpg") == "2019/plage.jpg"
+
+
+def test_sqlite_bank_matches_json_bank(banks):
+    json_bank, sqlite_bank = banks
+    assert sqlite_bank.database is not None
+    for key in ["01/plage.jpg", "02/neige.jpg", "03/nuit.jpg", "04/absente.jpg"]:
+        source = json_bank.source(key)
+        assert sqlite_bank.source(key) == source
+        if source is not None:
+            assert sqlite_bank.size(source) == json_bank.size(source)
+    assert json_bank.source("01/plage.jpg") == "/photos/2019/plage-originale.jpg"
+    assert json_bank.size("/photos/2019/plage-originale.jpg") == (4000, 3000)
+    assert sqlite_bank.size("wp-content/2019/03/nuit.jpg") is None
+
+
+def test_sqlite_bank_pickles_without_connection(banks):
+    _, sqlite_bank = banks
+    sqlite_bank.source("01/plage.jpg")
+    copy = pickle.loads(pickle.dumps(sqlite_bank))
+    assert copy.size("wp-content/2019/02/neige.jpg") == (640, 480)
+
+
+def test_sqlite_bank_rejects_other_versions(tmp_path):
+    database = tmp_path / "matcherdata.db"
+    ImageBank.write(database, MATCHES)
+    db = sqlite3.connect(str(database))
+    db.execute("PRAGMA user_version = {:d}".format(ImageBank.VERSION + 1))
+    db.close()
+    with pytest.raises(ValueError):
+        ImageBank.make(database).source("01/plage.jpg")
@@ -0,0 +1,54 @@
+import pathlib
+
+import markdown
+
+from site_markdown import ImageProcessor, ImageProcessorExtension
+
+
+class FakeFolder:
+    sizes = None
+    
+    def match(self, path, folder):
+        return pathlib.PurePosixPath("/photos") / folder / pathlib.PurePosixPath(path).name
+    
+    def dimensions(self, path):
+        return (800, 600)
+    
+    def placeholder(self, path):
+        return None
+    
+    def srcset(self, path, fmt="jpeg"):
+        return []
+    
+    def alternatives(self, path):
+        destination = self.match(path, "post")
+        return [("image/webp", destination.with_suffix(".webp"), [])]
+
+
+class FakeContext:
+    def url_for_abs(self, path):
+        return str(path)
+
+
+def convert(text):
+    processor = ImageProcessor("post", FakeFolder(), FakeContext())
+    md = markdown.Markdown(extensions=[ImageProcessorExtension(processor)])
+    return md.convert(text)
+
+
+def test_picture_sources_are_void_elements():
+    html = convert("![A photo](a/1.jpg)")
+    assert '<picture><source type="image/webp" srcset="/photos/post/1.webp"><img ' in html
+    assert "</source>" not in html
+
+
+def test_first_image_is_eager():
+    html = convert("![](a/1.jpg)\n\n![](a/2.jpg)")
+    assert html.count('loading="eager"') == 1
+    assert html.index('loading="eager"') < html.index('loading="lazy"')
+
+
+def test_empty_image_does_not_take_eager():
+    html = convert("![]()\n\n![](a/1.jpg)")
+    assert 'loading="eager"' in html
+    assert 'loading="lazy"' not in html
@@ -0,0 +1,37 @@
+from site_search import document_terms, fold, make_doc_shards, make_shards, terms
+
+
+def test_fold():
+    assert fold("Élève Cœur") == "eleve coeur"
+    assert fold("Ça ÆTHER straße") == "ca aether strasse"
+
+
+def test_terms():
+    # Stop words, single letters and elisions are dropped, plurals stemmed
+    assert terms("L'hiver des villes, jusqu'aux jeux") == ["hiver", "ville", "jeu"]
+
+
+def test_document_terms_weights():
+    scores = document_terms("Lyon", "Voyage à Lyon", "<p>Lyon <script>var x</script></p>")
+    assert scores == {"lyon": 4 + 2 + 1, "voyage": 2}
+
+
+def test_make_shards():
+    shards = make_shards({0: {"lyon": 1, "lys": 3}, 1: {"lyon": 5}, 2: {"paris": 2}}, 2)
+    assert shards == {
+        "ly": {"lyon": [[1, 5], [0, 1]], "lys": [[0, 3]]},
+        "pa": {"paris": [[2, 2]]},
+    }
+
+
+def test_make_shards_ties_by_id():
+    shards = make_shards({3: {"nice": 1}, 1: {"nice": 1}}, 1)
+    assert shards == {"n": {"nice": [[1, 1], [3, 1]]}}
+
+
+def test_make_doc_shards():
+    shards = make_doc_shards({0: ["a/", "A", ""], 2: ["b/", "B", ""], 5: ["c/", "C", ""]}, 4)
+    assert shards == {
+        0: [["a/", "A", ""], None, ["b/", "B", ""]],
+        1: [None, ["c/", "C", ""]],
+    }